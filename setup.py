@@ -1,22 +1,17 @@
 #!/usr/bin/env python
 
-import sys
-
 from setuptools import setup
 
-assert sys.version >= "2.7", "Requires Python v2.7 or above."
-
 with open("yeelight/version.py") as f:
     exec(f.read())
 
 classifiers = [
     "License :: OSI Approved :: BSD License",
     "Programming Language :: Python",
-    "Programming Language :: Python :: 2.7",
-    "Programming Language :: Python :: 3.2",
-    "Programming Language :: Python :: 3.3",
-    "Programming Language :: Python :: 3.4",
+    "Programming Language :: Python :: 3",
+    "Programming Language :: Python :: 3 :: Only",
     "Programming Language :: Python :: 3.5",
+    "Programming Language :: Python :: 3.6",
     "Topic :: Software Development :: Libraries :: Python Modules",
 ]
 
@@ -31,7 +26,9 @@ setup(
     license="BSD",
     classifiers=classifiers,
     packages=["yeelight"],
-    install_requires=["enum-compat", "future"],
+    python_requires=">=3.5",
+    install_requires=["enum-compat"],
+    extras_require={"numpy": ["numpy"]},
     test_suite="yeelight.tests",
     tests_require=[],
 )
@@ -2,7 +2,15 @@
 
 """A Python library for controlling YeeLight RGB bulbs."""
 
-from yeelight.main import Bulb, BulbType, BulbException, discover_bulbs
+from yeelight.main import (
+    Bulb,
+    BulbType,
+    BulbException,
+    RateLimitException,
+    StreamStats,
+    discover_bulbs,
+    discover_bulbs_iter,
+)
 from yeelight.flow import Flow, HSVTransition, RGBTransition, TemperatureTransition, SleepTransition
 
 from yeelight.version import __version__
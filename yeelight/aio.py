@@ -0,0 +1,314 @@
+"""An asyncio interface to YeeLight bulbs."""
+
+import asyncio
+import json
+import logging
+import socket
+import time
+
+from .flow import _MAX_TRANSITIONS, Action, Flow
+from .main import _AUTO_ON_METHODS, _DEFAULT_PROPERTIES, Bulb, BulbException, _build_command
+from .utils import _LineDecoder
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _async_command(method):
+    """
+    Return a coroutine version of a :py:class:`Bulb <yeelight.Bulb>` command method.
+
+    The returned coroutine builds the command exactly like the blocking method
+    does (effects, durations, power modes and the music mode cache), but sends
+    it over the bulb's asyncio connection.
+    """
+    f = method.__wrapped__
+
+    async def wrapper(self, *args, **kw):
+        command, params = _build_command(f, self, *args, **kw)
+        if command in _AUTO_ON_METHODS:
+            await self.async_ensure_on()
+
+        result = (await self.async_send_command(command, params)).get("result", [])
+        if result:
+            return result[0]
+
+    wrapper.__name__ = "async_" + method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class AsyncBulb(Bulb):
+    def __init__(self, *args, **kwargs):
+        """
+        A YeeLight bulb controlled through asyncio.
+
+        This accepts the same arguments as :py:class:`Bulb <yeelight.Bulb>`, and
+        adds coroutine versions of its methods, prefixed with ``async_`` (e.g.
+        ``await bulb.async_set_rgb(255, 0, 0)``). The coroutines use their own
+        connection to the bulb, so they never block the event loop.
+
+        The blocking methods are still available, but they use a separate
+        connection and will block the loop, so don't call them from a coroutine.
+        """
+        super(AsyncBulb, self).__init__(*args, **kwargs)
+
+        self._reader = None
+        self._writer = None
+        self._async_decoder = _LineDecoder()
+        self._lock = None  # Serializes requests on the asyncio connection.
+
+    async def _async_connection(self):
+        """Return, optionally creating, the asyncio connection to the bulb."""
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self._ip, self._port), 5)
+            self._async_decoder = _LineDecoder()
+        return self._reader, self._writer
+
+    def _async_disconnect(self):
+        """Close the asyncio connection, so that a new one is created on the next command."""
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+    async def async_close(self):
+        """Close the asyncio connection to the bulb."""
+        self._async_disconnect()
+
+    async def async_send_command(self, method, params=None):
+        """
+        Send a command to the bulb without blocking the event loop.
+
+        :param str method:  The name of the method to send.
+        :param list params: The list of parameters for the method.
+
+        :raises BulbException: When the bulb indicates an error condition, or
+                               doesn't support the method.
+        :raises RateLimitException: When the command would exceed the rate
+                                    limit and ``rate_limit_wait`` is False.
+        :returns: The response from the bulb.
+        """
+        self._check_supported(method)
+        await asyncio.sleep(self._throttle_delay())
+        sent = time.monotonic()
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            command = {"id": self._cmd_id, "method": method, "params": params}
+
+            _LOGGER.debug("%s > %s", self, command)
+
+            try:
+                reader, writer = await self._async_connection()
+                writer.write((json.dumps(command) + "\r\n").encode("utf8"))
+                await writer.drain()
+            except (OSError, asyncio.TimeoutError) as ex:
+                self._async_disconnect()
+                raise BulbException("A socket error occurred when sending the command.") from ex
+
+            if self._music_mode:
+                # We're in music mode, nothing else will happen.
+                return {"result": ["ok"]}
+
+            # The bulb will send us updates on its state in addition to responses,
+            # so we want to make sure that we read until we see our response.
+            response = None
+            while response is None:
+                try:
+                    data = await asyncio.wait_for(reader.read(16 * 1024), 5)
+                except (OSError, asyncio.TimeoutError):
+                    data = b""
+
+                if not data:
+                    self._async_disconnect()
+                    response = {"error": "Bulb closed the connection."}
+                    break
+
+                for line in self._async_decoder.feed(data):
+                    _LOGGER.debug("%s < %s", self, line)
+
+                    if line.get("method") == "props":
+                        self._update_properties(line["params"])
+                    elif line.get("id", command["id"]) == command["id"]:
+                        response = line
+
+        if "error" in response:
+            raise BulbException(response["error"])
+
+        self._track_power(method, params, sent)
+        return response
+
+    async def async_ensure_on(self):
+        """Turn the bulb on if it is off."""
+        if self._music_mode is True or self.auto_on is False:
+            return
+
+        if not self._is_fresh("power", self.power_ttl):
+            await self.async_get_properties()
+
+        if self._last_properties.get("power") != "on":
+            await self.async_turn_on()
+
+    async def async_get_properties(self, requested_properties=_DEFAULT_PROPERTIES, max_age=None):
+        """
+        Retrieve and return the properties of the bulb.
+
+        See :py:meth:`get_properties() <yeelight.Bulb.get_properties()>`.
+
+        :param list requested_properties: The list of properties to request from the bulb.
+        :param float max_age: How many seconds old the cached properties can
+                              be. By default, all the properties are queried.
+
+        :returns: A dictionary of param: value items.
+        :rtype: dict
+        """
+        if self._music_mode:
+            return self._last_properties
+
+        stale = self._stale_properties(requested_properties, max_age)
+        if stale:
+            response = await self.async_send_command("get_prop", stale)
+            self._store_properties(stale, response)
+        return self._cached_properties(requested_properties)
+
+    async def async_set_power_mode(self, mode):
+        """
+        Set the light power mode.
+
+        If the light is off it will be turned on.
+
+        :param yeelight.enums.PowerMode mode: The mode to swith to.
+        """
+        return await self.async_turn_on(power_mode=mode)
+
+    async def async_run_flow(self, flow):
+        """
+        Start a flow of any length.
+
+        See :py:meth:`run_flow() <yeelight.Bulb.run_flow()>`. The first segment
+        is started before this returns, and the rest are started by a task on
+        the event loop, which :py:meth:`async_stop_flow()` cancels.
+
+        :param yeelight.Flow flow: The Flow instance to start.
+
+        :returns: The task that starts the remaining segments, or None if the
+                  flow was started in one go.
+        :rtype: asyncio.Task
+        """
+        if not isinstance(flow, Flow):
+            raise ValueError("Argument is not a Flow instance.")
+
+        if self._flow_runner is not None:
+            self._flow_runner.cancel()
+            self._flow_runner = None
+
+        if len(flow.transitions) <= _MAX_TRANSITIONS:
+            await self.async_start_flow(flow)
+            return None
+
+        properties = None
+        if flow.count and flow.action is Action.recover:
+            properties = await self.async_get_properties()
+
+        # Turn the bulb on once, rather than before every segment, so that the
+        # segments are sent on time.
+        await self.async_ensure_on()
+        segments = flow._segments(properties=properties)
+        segment, duration = next(segments)
+        start = time.monotonic()
+        await self.async_send_command("start_cf", segment.params)
+
+        async def run(due):
+            for segment, duration in segments:
+                await asyncio.sleep(max(0, due - time.monotonic()))
+                await self.async_send_command("start_cf", segment.params)
+                due += duration
+
+        self._flow_runner = asyncio.ensure_future(run(start + duration))
+        return self._flow_runner
+
+    async def async_start_music(self, port=0, timeout=5):
+        """
+        Start music mode on the asyncio connection.
+
+        See :py:meth:`start_music() <yeelight.Bulb.start_music()>`. While
+        waiting for the bulb to connect, the event loop keeps running, and the
+        coroutine can be cancelled. If the bulb doesn't connect back within
+        ``timeout`` seconds, or the coroutine is cancelled, the bulb is told to
+        leave music mode and the old connection keeps being used.
+
+        :param int port: The port to listen on. If none is specified, a random
+                         port will be chosen.
+        :param float timeout: How many seconds to wait for the bulb to connect.
+
+        :raises BulbException: When the bulb did not connect back in time.
+        """
+        if self._music_mode:
+            raise AssertionError("Already in music mode, please stop music mode first.")
+
+        # Force populating the cache in case we are being called directly
+        # without ever fetching properties beforehand
+        await self.async_get_properties()
+
+        connected = asyncio.get_event_loop().create_future()
+
+        def accept(reader, writer):
+            if connected.done():
+                writer.close()
+            else:
+                connected.set_result((reader, writer))
+
+        server = await asyncio.start_server(accept, "", port, family=socket.AF_INET)
+        try:
+            local_ip = self._writer.get_extra_info("sockname")[0]
+            await self.async_send_command("set_music", [1, local_ip, server.sockets[0].getsockname()[1]])
+            reader, writer = await asyncio.wait_for(connected, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as ex:
+            # Make sure the bulb doesn't try to connect later, and keep using
+            # the old connection.
+            try:
+                await self.async_send_command("set_music", [0])
+            except BulbException:
+                _LOGGER.debug("%s: Could not cancel music mode.", self)
+
+            if isinstance(ex, asyncio.CancelledError):
+                raise
+            raise BulbException("The bulb did not connect back for music mode.") from ex
+        finally:
+            server.close()  # Close the listening socket.
+
+        self._async_disconnect()
+        self._reader, self._writer = reader, writer
+        self._async_decoder = _LineDecoder()
+        self._music_mode = True
+        return "ok"
+
+    async def async_stop_music(self):
+        """
+        Stop music mode on the asyncio connection.
+
+        See :py:meth:`stop_music() <yeelight.Bulb.stop_music()>`.
+        """
+        self._async_disconnect()
+        self._music_mode = False
+        result = (await self.async_send_command("set_music", [0])).get("result", [])
+        if result:
+            return result[0]
+
+    async_set_color_temp = _async_command(Bulb.set_color_temp)
+    async_set_rgb = _async_command(Bulb.set_rgb)
+    async_set_adjust = _async_command(Bulb.set_adjust)
+    async_set_hsv = _async_command(Bulb.set_hsv)
+    async_set_brightness = _async_command(Bulb.set_brightness)
+    async_turn_on = _async_command(Bulb.turn_on)
+    async_turn_off = _async_command(Bulb.turn_off)
+    async_toggle = _async_command(Bulb.toggle)
+    async_set_default = _async_command(Bulb.set_default)
+    async_set_name = _async_command(Bulb.set_name)
+    async_start_flow = _async_command(Bulb.start_flow)
+    async_stop_flow = _async_command(Bulb.stop_flow)
+    async_cron_add = _async_command(Bulb.cron_add)
+    async_cron_get = _async_command(Bulb.cron_get)
+    async_cron_del = _async_command(Bulb.cron_del)
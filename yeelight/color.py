@@ -0,0 +1,211 @@
+"""
+Color conversions, for one color or for many colors at once.
+
+Every converter accepts either single numbers or sequences (lists, tuples or
+NumPy arrays) of them. Single numbers return a single packed RGB integer, as
+the bulbs expect it. Sequences return a NumPy array of integers if NumPy is
+installed, or a list of integers otherwise, and the other arguments can be
+single numbers, which apply to every color::
+
+    >>> hsv_to_rgb(240, 100)
+    196863
+    >>> hsv_to_rgb([0, 120, 240], 100)
+    array([16711680,    65281,   196863])
+
+Like :py:meth:`Bulb.set_hsv() <yeelight.Bulb.set_hsv()>`, hues are scaled by
+359, not 360, so the hues of the primary colors aren't exactly pure.
+
+Both ways give exactly the same results as converting the colors one at a time
+with :py:mod:`colorsys`.
+"""
+
+import colorsys
+import math
+
+from .utils import _clamp
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# The packed RGB values of the colors converted so far, so that the common
+# case of whole-number hues and saturations is a dictionary lookup.
+_HSV_TABLE = {}
+_KELVIN_TABLE = {}
+_TABLE_SIZE = 65536
+
+
+def _is_scalar(value):
+    """Return whether the value is a single number, rather than a sequence of them."""
+    return not hasattr(value, "__len__")
+
+
+def _columns(*values):
+    """Return the values as equally long lists, repeating single numbers as needed."""
+    length = max(len(value) for value in values if not _is_scalar(value))
+    columns = [[value] * length if _is_scalar(value) else list(value) for value in values]
+    if any(len(column) != length for column in columns):
+        raise ValueError("All the color sequences must have the same length.")
+    return columns
+
+
+def _hsv_to_int(hue, saturation, value):
+    """Convert a single HSV color to a packed RGB integer."""
+    key = (_clamp(hue, 0, 359), _clamp(saturation, 0, 100), _clamp(value, 0, 100))
+    try:
+        return _HSV_TABLE[key]
+    except KeyError:
+        pass
+
+    red, green, blue = [
+        int(round(col * 255)) for col in colorsys.hsv_to_rgb(key[0] / 359.0, key[1] / 100.0, key[2] / 100.0)
+    ]
+    rgb = red * 65536 + green * 256 + blue
+    if len(_HSV_TABLE) < _TABLE_SIZE:
+        _HSV_TABLE[key] = rgb
+    return rgb
+
+
+def _numpy_hsv_to_rgb(hue, saturation, value):
+    """Convert arrays of HSV colors to packed RGB integers, exactly like :py:func:`colorsys.hsv_to_rgb` does."""
+    h, s, v = numpy.broadcast_arrays(
+        numpy.clip(numpy.asarray(hue, dtype=float), 0, 359) / 359.0,
+        numpy.clip(numpy.asarray(saturation, dtype=float), 0, 100) / 100.0,
+        numpy.clip(numpy.asarray(value, dtype=float), 0, 100) / 100.0,
+    )
+    i = (h * 6.0).astype(int)
+    f = (h * 6.0) - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    i = i % 6
+
+    red = numpy.choose(i, [v, q, p, p, t, v])
+    green = numpy.choose(i, [t, v, v, q, p, p])
+    blue = numpy.choose(i, [p, p, t, v, v, q])
+
+    # numpy.rint() rounds halves to even, like round() does.
+    red, green, blue = [numpy.rint(col * 255).astype(int) for col in (red, green, blue)]
+    return red * 65536 + green * 256 + blue
+
+
+def hsv_to_rgb(hue, saturation, value=100):
+    """
+    Convert HSV colors to packed RGB integers.
+
+    The values are clamped to their ranges first, like :py:meth:`Bulb.set_hsv()
+    <yeelight.Bulb.set_hsv()>` does.
+
+    :param int hue: The hue, or hues (0-359).
+    :param int saturation: The saturation, or saturations (0-100).
+    :param int value: The value, or values (0-100).
+
+    :returns: The packed RGB value, or values.
+    """
+    if _is_scalar(hue) and _is_scalar(saturation) and _is_scalar(value):
+        return _hsv_to_int(hue, saturation, value)
+
+    if numpy is not None:
+        return _numpy_hsv_to_rgb(hue, saturation, value)
+
+    table = _HSV_TABLE
+    return [table[color] if color in table else _hsv_to_int(*color) for color in zip(*_columns(hue, saturation, value))]
+
+
+def rgb_to_int(red, green, blue):
+    """
+    Pack RGB colors into integers, the way the bulbs expect them.
+
+    :param int red: The red component, or components (0-255).
+    :param int green: The green component, or components (0-255).
+    :param int blue: The blue component, or components (0-255).
+
+    :returns: The packed RGB value, or values.
+    """
+    if _is_scalar(red) and _is_scalar(green) and _is_scalar(blue):
+        return _clamp(red, 0, 255) * 65536 + _clamp(green, 0, 255) * 256 + _clamp(blue, 0, 255)
+
+    if numpy is not None:
+        # Widen the components first, as narrow types (like the uint8 of
+        # images) would overflow when packed.
+        red, green, blue = [numpy.clip(numpy.asarray(col, dtype=numpy.int64), 0, 255) for col in (red, green, blue)]
+        return red * 65536 + green * 256 + blue
+
+    return [rgb_to_int(*color) for color in zip(*_columns(red, green, blue))]
+
+
+def _kelvin_to_int(kelvin):
+    """Convert a single color temperature to a packed RGB integer."""
+    kelvin = _clamp(kelvin, 1000, 40000)
+    try:
+        return _KELVIN_TABLE[kelvin]
+    except KeyError:
+        pass
+
+    temperature = kelvin / 100.0
+    if temperature <= 66:
+        red = 255
+        green = 99.4708025861 * math.log(temperature) - 161.1195681661
+    else:
+        red = 329.698727446 * (temperature - 60) ** -0.1332047592
+        green = 288.1221695283 * (temperature - 60) ** -0.0755148492
+
+    if temperature >= 66:
+        blue = 255
+    elif temperature <= 19:
+        blue = 0
+    else:
+        blue = 138.5177312231 * math.log(temperature - 10) - 305.0447927307
+
+    red, green, blue = [int(round(_clamp(col, 0, 255))) for col in (red, green, blue)]
+    rgb = red * 65536 + green * 256 + blue
+    if len(_KELVIN_TABLE) < _TABLE_SIZE:
+        _KELVIN_TABLE[kelvin] = rgb
+    return rgb
+
+
+def _numpy_kelvin_to_rgb(kelvin):
+    """Convert an array of color temperatures to packed RGB integers."""
+    temperature = numpy.clip(numpy.asarray(kelvin, dtype=float), 1000, 40000) / 100.0
+
+    # Both branches are computed for every temperature, so ignore the warnings
+    # from the ones that are thrown away.
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        warm = temperature <= 66
+        red = numpy.where(warm, 255, 329.698727446 * (temperature - 60) ** -0.1332047592)
+        green = numpy.where(
+            warm,
+            99.4708025861 * numpy.log(temperature) - 161.1195681661,
+            288.1221695283 * (temperature - 60) ** -0.0755148492,
+        )
+        blue = numpy.where(
+            temperature >= 66,
+            255,
+            numpy.where(temperature <= 19, 0, 138.5177312231 * numpy.log(temperature - 10) - 305.0447927307),
+        )
+
+    red, green, blue = [numpy.rint(numpy.clip(col, 0, 255)).astype(int) for col in (red, green, blue)]
+    return red * 65536 + green * 256 + blue
+
+
+def kelvin_to_rgb(kelvin):
+    """
+    Convert color temperatures to packed RGB integers.
+
+    This approximates the color of a black body at that temperature, which is
+    useful for previewing what a bulb in color temperature mode looks like, or
+    for mixing color temperatures into RGB effects.
+
+    :param int kelvin: The color temperature, or temperatures, in degrees
+                       Kelvin (1000-40000).
+
+    :returns: The packed RGB value, or values.
+    """
+    if _is_scalar(kelvin):
+        return _kelvin_to_int(kelvin)
+
+    if numpy is not None:
+        return _numpy_kelvin_to_rgb(kelvin)
+
+    return [_kelvin_to_int(degrees) for degrees in kelvin]
@@ -0,0 +1,494 @@
+"""Passive discovery of the bulbs on the local network."""
+
+import errno
+import ipaddress
+import json
+import logging
+import os
+import select
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from .main import _DISCOVERY_MESSAGE, _parse_capabilities, _parse_headers, discover_bulbs_iter, get_ip_address
+from .utils import _LineDecoder
+
+_LOGGER = logging.getLogger(__name__)
+
+_MULTICAST_GROUP = "239.255.255.250"
+_MULTICAST_PORT = 1982
+_DEFAULT_MAX_AGE = 3600
+
+# The properties scan_bulbs() asks each bulb for.
+_SCAN_PROPERTIES = ["power", "bright", "ct", "rgb", "hue", "sat", "color_mode", "name"]
+
+
+def _max_age(headers):
+    """Return how many seconds an SSDP message is valid for, from its Cache-Control header."""
+    for directive in headers.get("Cache-Control", "").split(","):
+        key, _, value = directive.partition("=")
+        if key.strip().lower() == "max-age":
+            try:
+                return int(value)
+            except ValueError:
+                break
+    return _DEFAULT_MAX_AGE
+
+
+class BulbListener(object):
+    def __init__(self, on_appear=None, on_change=None, on_expire=None, interface=False):
+        """
+        A live inventory of the bulbs on the local network.
+
+        The bulbs periodically advertise themselves (and their current state)
+        to a multicast group. The listener joins that group, and keeps track of
+        every bulb it hears from, until its advertisement expires::
+
+            >>> listener = BulbListener(on_appear=print)
+            >>> listener.start()
+            >>> listener.bulbs
+            {'0x0000000002dfb19a': {'ip': '192.168.0.19',
+                                    'port': 55443,
+                                    'capabilities': {...}}}
+
+        Each bulb is the same dictionary :py:func:`discover_bulbs
+        <yeelight.discover_bulbs>` returns. The callbacks are called from the
+        listener's thread, with that dictionary as their only argument.
+
+        :param callable on_appear: Called when a new bulb is seen.
+        :param callable on_change: Called when a bulb's address or capabilities
+                                   (which include its state) change.
+        :param callable on_expire: Called when a bulb hasn't advertised itself
+                                   for longer than its advertisement was valid.
+        :param string interface: The interface to listen on. The default one
+                                 will be used if this is not specified.
+        """
+        self.on_appear = on_appear
+        self.on_change = on_change
+        self.on_expire = on_expire
+        self.interface = interface
+
+        self._bulbs = {}  # Bulb ID: bulb dictionary.
+        self._expires = {}  # Bulb ID: when its advertisement expires.
+        self._lock = threading.Lock()
+        self._socket = None
+        self._thread = None
+        self._running = False
+
+    @property
+    def bulbs(self):
+        """
+        The bulbs currently on the network.
+
+        :rtype: dict
+        :returns: A dictionary of bulb ID: bulb dictionary items.
+        """
+        with self._lock:
+            return dict(self._bulbs)
+
+    def start(self):
+        """Start listening for advertisements in a background thread, and ask all the bulbs to respond."""
+        if self._thread is not None:
+            return
+
+        self._socket = self._open_socket()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="yeelight-discovery")
+        self._thread.daemon = True
+        self._thread.start()
+        self.search()
+
+    def stop(self):
+        """Stop listening for advertisements."""
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def search(self):
+        """
+        Ask all the bulbs to respond right away, instead of waiting for their next advertisement.
+
+        The responses are sent to the listener's socket, so they update the
+        inventory like advertisements do.
+        """
+        self._socket.sendto(_DISCOVERY_MESSAGE, (_MULTICAST_GROUP, _MULTICAST_PORT))
+
+    def _open_socket(self):
+        """Create a socket that receives the advertisements sent to the multicast group."""
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # Let other processes listen for the advertisements too.
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind(("", _MULTICAST_PORT))
+
+        local_ip = get_ip_address(self.interface) if self.interface else "0.0.0.0"
+        membership = struct.pack("4s4s", socket.inet_aton(_MULTICAST_GROUP), socket.inet_aton(local_ip))
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
+        if self.interface:
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(local_ip))
+        return s
+
+    def _run(self):
+        """Receive advertisements until the listener is stopped."""
+        while self._running:
+            # Wake up regularly, to expire bulbs and notice when we're stopped.
+            readable, _, _ = select.select([self._socket], [], [], 1)
+            if readable:
+                try:
+                    data, _ = self._socket.recvfrom(65507)
+                except socket.error:
+                    continue
+                self._handle_message(data, time.monotonic())
+            self._expire(time.monotonic())
+
+    def _handle_message(self, data, now):
+        """
+        Update the inventory from an advertisement or a discovery response.
+
+        :param bytes data: The message.
+        :param float now: The current time, from ``time.monotonic()``.
+        """
+        headers = _parse_headers(data)
+        bulb = _parse_capabilities(headers)
+        if bulb is None or "id" not in bulb["capabilities"]:
+            # This is a search, possibly our own, or a message from another device.
+            return
+
+        bulb_id = bulb["capabilities"]["id"]
+        if headers.get("NTS") == "ssdp:byebye":
+            self._expire(now, bulb_id)
+            return
+
+        with self._lock:
+            previous = self._bulbs.get(bulb_id)
+            self._bulbs[bulb_id] = bulb
+            self._expires[bulb_id] = now + _max_age(headers)
+
+        if previous is None:
+            _LOGGER.debug("Bulb %s appeared at %s.", bulb_id, bulb["ip"])
+            self._callback(self.on_appear, bulb)
+        elif previous != bulb:
+            _LOGGER.debug("Bulb %s changed.", bulb_id)
+            self._callback(self.on_change, bulb)
+
+    def _expire(self, now, bulb_id=None):
+        """
+        Forget the bulbs whose advertisements have expired.
+
+        :param float now: The current time, from ``time.monotonic()``.
+        :param str bulb_id: A bulb to forget regardless of when its advertisement expires.
+        """
+        with self._lock:
+            expired = [key for key, expires in self._expires.items() if expires <= now or key == bulb_id]
+            bulbs = [self._bulbs.pop(key) for key in expired]
+            for key in expired:
+                del self._expires[key]
+
+        for bulb in bulbs:
+            _LOGGER.debug("Bulb %s expired.", bulb["capabilities"]["id"])
+            self._callback(self.on_expire, bulb)
+
+    def _callback(self, callback, bulb):
+        """Call one of the callbacks, making sure its errors don't stop the listener."""
+        if callback is None:
+            return
+        try:
+            callback(bulb)
+        except Exception:
+            _LOGGER.exception("Exception in discovery callback.")
+
+
+class _Probe(object):
+    """A connection scan_bulbs() is making to a single host."""
+
+    def __init__(self, ip, sock, deadline):
+        self.ip = ip
+        self.sock = sock
+        self.deadline = deadline
+        self.connected = False
+        self.decoder = _LineDecoder()
+
+
+def scan_bulbs(network, port=55443, timeout=1, concurrency=256):
+    """
+    Find the bulbs in a range of addresses, without using multicast.
+
+    Every address in the range is connected to on the bulbs' command port, many
+    at a time, and the hosts that accept the connection are asked for their
+    properties. This is useful on networks that filter multicast traffic::
+
+        >>> scan_bulbs("192.168.0.0/24")
+        [{'ip': '192.168.0.19', 'port': 55443, 'capabilities': {'power': 'on', ...}}]
+
+    Bulbs don't report their ID, model or supported methods through the
+    command port, so the capabilities only contain the bulb's state.
+
+    :param str network: The range of addresses to scan, in CIDR notation
+                        (e.g. ``"192.168.0.0/22"``).
+    :param int port: The port to connect to.
+    :param float timeout: How many seconds to wait for each host to accept the
+                          connection, and then to respond.
+    :param int concurrency: How many hosts to probe at the same time.
+
+    :returns: A list of dictionaries, containing the ip, port and capabilities
+              of each of the bulbs found.
+    """
+    network = ipaddress.ip_network(network, strict=False)
+    hosts = iter(network.hosts() if network.num_addresses > 1 else [network.network_address])
+    command = (json.dumps({"id": 1, "method": "get_prop", "params": _SCAN_PROPERTIES}) + "\r\n").encode("utf8")
+
+    selector = selectors.DefaultSelector()
+    probes = set()
+    bulbs = []
+
+    def close(probe):
+        selector.unregister(probe.sock)
+        probe.sock.close()
+        probes.discard(probe)
+
+    try:
+        while True:
+            # Keep as many connections in flight as we're allowed.
+            while len(probes) < concurrency:
+                ip = next(hosts, None)
+                if ip is None:
+                    break
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                error = sock.connect_ex((str(ip), port))
+                if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    sock.close()
+                    continue
+                probe = _Probe(str(ip), sock, time.monotonic() + timeout)
+                selector.register(sock, selectors.EVENT_WRITE, probe)
+                probes.add(probe)
+
+            if not probes:
+                break
+
+            wait = max(0, min(probe.deadline for probe in probes) - time.monotonic())
+            for key, _ in selector.select(wait):
+                probe = key.data
+                if not probe.connected:
+                    if probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                        close(probe)
+                        continue
+                    probe.connected = True
+                    probe.deadline = time.monotonic() + timeout
+                    try:
+                        probe.sock.send(command)
+                    except socket.error:
+                        close(probe)
+                        continue
+                    selector.modify(probe.sock, selectors.EVENT_READ, probe)
+                    continue
+
+                try:
+                    data = probe.sock.recv(16 * 1024)
+                except socket.error:
+                    data = b""
+                if not data:
+                    close(probe)
+                    continue
+
+                for line in probe.decoder.feed(data):
+                    if line.get("id") == 1 and "result" in line:
+                        capabilities = dict(zip(_SCAN_PROPERTIES, line["result"]))
+                        bulbs.append({"ip": probe.ip, "port": port, "capabilities": capabilities})
+                        close(probe)
+                        break
+
+            now = time.monotonic()
+            for probe in [probe for probe in probes if probe.deadline <= now]:
+                close(probe)
+    finally:
+        for probe in list(probes):
+            close(probe)
+        selector.close()
+
+    return bulbs
+
+
+def _default_cache_path():
+    """Return where the discovery cache is kept by default."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "yeelight", "bulbs.json")
+
+
+class DiscoveryCache(object):
+    def __init__(self, path=None, ttl=24 * 3600):
+        """
+        An on-disk cache of discovered bulbs, for starting up without waiting for discovery.
+
+        Bulbs rarely change addresses, so the cache returns the bulbs it
+        already knows about right away, and checks in the background that
+        they are still where it thinks they are::
+
+            >>> cache = DiscoveryCache()
+            >>> cache.discover()
+            [{'ip': '192.168.0.19', 'port': 55443, 'capabilities': {...}}]
+
+        Each bulb is the same dictionary :py:func:`discover_bulbs
+        <yeelight.discover_bulbs>` returns. The cache is keyed by bulb ID, so
+        bulbs that moved are found at their new address.
+
+        :param str path: The file to keep the cache in. By default,
+                         ``yeelight/bulbs.json`` in the user's cache directory.
+        :param int ttl: How many seconds a bulb stays in the cache after it
+                        was last seen.
+        """
+        self.path = path or _default_cache_path()
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = None  # Bulb ID: bulb dictionary, plus when it was last seen.
+
+    @property
+    def bulbs(self):
+        """
+        The bulbs in the cache that haven't expired.
+
+        :rtype: list
+        :returns: A list of dictionaries, containing the ip, port and
+                  capabilities of each bulb.
+        """
+        now = time.time()
+        with self._lock:
+            entries = self._load()
+            return [
+                {key: value for key, value in entry.items() if key != "seen"}
+                for entry in entries.values()
+                if entry["seen"] + self.ttl > now
+            ]
+
+    def discover(self, timeout=2, interface=False, revalidate=True):
+        """
+        Return the bulbs in the network, from the cache if possible.
+
+        If the cache has any bulbs, they are returned immediately, and
+        (unless ``revalidate`` is False) checked in a background thread with
+        :py:meth:`revalidate() <revalidate>`. Otherwise, the bulbs are
+        discovered, stored in the cache and returned.
+
+        :param int timeout: How many seconds to wait for replies.
+        :param string interface: The interface that should be used for
+                                 multicast packets.
+        :param bool revalidate: Whether to check the cached bulbs in the
+                                background.
+
+        :rtype: list
+        :returns: A list of dictionaries, containing the ip, port and
+                  capabilities of each bulb.
+        """
+        bulbs = self.bulbs
+        if not bulbs:
+            bulbs = list(discover_bulbs_iter(timeout, interface))
+            self.update(bulbs)
+            return bulbs
+
+        if revalidate:
+            thread = threading.Thread(target=self.revalidate, args=(timeout, interface), name="yeelight-cache")
+            thread.daemon = True
+            thread.start()
+        return bulbs
+
+    def revalidate(self, timeout=2, interface=False):
+        """
+        Check that the cached bulbs are still where the cache thinks they are.
+
+        Each cached bulb is asked to respond directly, at its cached address.
+        The bulbs that don't are looked for with multicast discovery, in case
+        they have moved. Every bulb that responds is refreshed in the cache.
+
+        :param int timeout: How many seconds to wait for replies.
+        :param string interface: The interface that should be used for
+                                 multicast packets.
+
+        :rtype: list
+        :returns: The bulbs that responded.
+        """
+        cached = self.bulbs
+        found = {}
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            for bulb in cached:
+                try:
+                    s.sendto(_DISCOVERY_MESSAGE, (bulb["ip"], _MULTICAST_PORT))
+                except socket.error:
+                    _LOGGER.debug("Could not probe %s.", bulb["ip"])
+
+            deadline = time.monotonic() + timeout
+            waiting = {bulb["capabilities"].get("id") for bulb in cached}
+            while waiting - set(found) and time.monotonic() < deadline:
+                readable, _, _ = select.select([s], [], [], max(0, deadline - time.monotonic()))
+                if not readable:
+                    break
+                data, _ = s.recvfrom(65507)
+                bulb = _parse_capabilities(_parse_headers(data))
+                if bulb is not None and "id" in bulb["capabilities"]:
+                    found[bulb["capabilities"]["id"]] = bulb
+        finally:
+            s.close()
+
+        missing = waiting - set(found)
+        if missing:
+            _LOGGER.debug("Looking for cached bulbs %s with multicast discovery.", ", ".join(sorted(missing)))
+            for bulb in discover_bulbs_iter(timeout, interface, expected=missing):
+                found[bulb["capabilities"].get("id")] = bulb
+
+        self.update(found.values())
+        return list(found.values())
+
+    def update(self, bulbs):
+        """
+        Store bulbs that were just seen in the cache, and save it.
+
+        :param list bulbs: The bulb dictionaries to store, e.g. the ones
+                           :py:func:`discover_bulbs <yeelight.discover_bulbs>`
+                           returned.
+        """
+        now = time.time()
+        with self._lock:
+            entries = self._load()
+            for bulb in bulbs:
+                bulb_id = bulb["capabilities"].get("id")
+                if bulb_id:
+                    entries[bulb_id] = dict(bulb, seen=now)
+
+            # Drop the expired bulbs, so the cache doesn't grow forever.
+            for bulb_id in [key for key, entry in entries.items() if entry["seen"] + self.ttl <= now]:
+                del entries[bulb_id]
+            self._save(entries)
+
+    def _load(self):
+        """Return the cache's entries, reading them from disk the first time."""
+        if self._entries is None:
+            try:
+                with open(self.path) as cache_file:
+                    self._entries = json.load(cache_file)["bulbs"]
+            except (IOError, OSError, ValueError, KeyError, TypeError):
+                # The cache doesn't exist yet, or it's corrupt.
+                self._entries = {}
+        return self._entries
+
+    def _save(self, entries):
+        """Write the cache's entries to disk."""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Write to a temporary file first, so other processes never read half a cache.
+        temporary_path = "%s.%s.tmp" % (self.path, os.getpid())
+        with open(temporary_path, "w") as cache_file:
+            json.dump({"bulbs": entries}, cache_file, indent=2, sort_keys=True)
+        os.replace(temporary_path, self.path)
+        self._entries = entries
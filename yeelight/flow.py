@@ -1,12 +1,17 @@
-import colorsys
 import logging
+import threading
+import time
 from enum import Enum
-from itertools import chain
+from itertools import chain, islice, repeat
 
+from .color import hsv_to_rgb, rgb_to_int
 from .utils import _clamp
 
 _LOGGER = logging.getLogger(__name__)
 
+# The most transitions the bulbs accept in a single flow.
+_MAX_TRANSITIONS = 9
+
 
 class Action(Enum):
     """
@@ -50,10 +55,16 @@ class Flow(object):
         self.action = action
         self.transitions = transitions
 
+        # The compiled flow, as a (key, expression, start_cf params) tuple.
+        self._compiled = None
+
         # Note, main depends on us, so we cannot import BulbException here.
-        if len(self.transitions) > 9:
+        if len(self.transitions) > _MAX_TRANSITIONS:
             _LOGGER.warning(
-                "The bulb seems to support up to 9 transitions. Your %s might fail." % len(self.transitions)
+                "The bulb seems to support up to %s transitions, so your %s might fail with start_flow(). "
+                "Use run_flow() to run longer flows.",
+                _MAX_TRANSITIONS,
+                len(self.transitions),
             )
 
     @property
@@ -61,16 +72,84 @@ class Flow(object):
         """
         Return a YeeLight-compatible expression that implements this flow.
 
+        The expression is only built again if the flow or its transitions
+        have changed since it was last built.
+
         :rtype: list
         """
-        expr = chain.from_iterable(transition.as_list() for transition in self.transitions)
-        expr = ", ".join(str(value) for value in expr)
-        return expr
+        return self._compile()[1]
+
+    @property
+    def params(self):
+        """
+        Return the parameters of the ``start_cf`` command that runs this flow.
+
+        :rtype: list
+        """
+        return list(self._compile()[2])
+
+    def _compile(self):
+        """
+        Build the expression and ``start_cf`` parameters, unless they're already built.
+
+        :returns: A (key, expression, params) tuple, where the key identifies
+                  the state of the flow it was built from.
+        :rtype: tuple
+        """
+        # The transitions count themselves as changed when any of their
+        # attributes are set, so this is enough to tell if anything changed.
+        key = (self.count, self.action, tuple((transition, transition._version) for transition in self.transitions))
+        if self._compiled is None or self._compiled[0] != key:
+            expr = chain.from_iterable(transition.as_list() for transition in self.transitions)
+            expr = ", ".join(str(value) for value in expr)
+            self._compiled = (key, expr, (self.count * len(self.transitions), self.action.value, expr))
+        return self._compiled
+
+    def _segments(self, size=_MAX_TRANSITIONS, properties=None):
+        """
+        Split the flow into flows of at most ``size`` transitions, to run one after the other.
+
+        Every segment runs its transitions once and stays at its last state,
+        until the next segment starts. The last segment ends with the flow's
+        action. The bulb can only recover the state from before the last
+        segment, so, to recover the state from before the whole flow, pass the
+        bulb's properties from before the flow started, and the last segment
+        will go back to them.
+
+        :param int size: The most transitions a segment can have.
+        :param dict properties: The bulb's properties before the flow started.
+
+        :returns: A generator of (flow, duration in seconds) tuples, which
+                  doesn't end if the flow runs forever.
+        """
+        if self.count:
+            transitions = chain.from_iterable(repeat(self.transitions, self.count))
+        else:
+            transitions = chain.from_iterable(repeat(self.transitions))
+
+        action = self.action
+        restore = _restore_transitions(properties) if action is Action.recover and properties else []
+        if restore:
+            transitions = chain(transitions, restore)
+            action = Action.off if properties.get("power") == "off" else Action.stay
+
+        segment = list(islice(transitions, size))
+        while segment:
+            following = list(islice(transitions, size))
+            flow = Flow(1, action if not following else Action.stay, segment)
+            yield flow, sum(max(50, transition.duration) for transition in segment) / 1000.0
+            segment = following
 
 
 class FlowTransition(object):
     """A single transition in the flow."""
 
+    _version = 0  # Incremented every time an attribute is set.
+
+    def __setattr__(self, name, value):
+        super(FlowTransition, self).__setattr__(name, value)
+        super(FlowTransition, self).__setattr__("_version", self._version + 1)
+
     def as_list(self):
         """
         Return a YeeLight-compatible expression that implements this transition.
@@ -107,10 +186,7 @@ class RGBTransition(FlowTransition):
     @property
     def _value(self):
         """The YeeLight-compatible value for this transition."""
-        red = _clamp(self.red, 0, 255)
-        green = _clamp(self.green, 0, 255)
-        blue = _clamp(self.blue, 0, 255)
-        return red * 65536 + green * 256 + blue
+        return rgb_to_int(self.red, self.green, self.blue)
 
     def __repr__(self):
         return "<%s(%s,%s,%s) duration %s, brightness %s>" % (
@@ -146,11 +222,7 @@ class HSVTransition(FlowTransition):
     @property
     def _value(self):
         """The YeeLight-compatible value for this transition."""
-        hue = _clamp(self.hue, 0, 359) / 359.0
-        saturation = max(0, min(100, self.saturation)) / 100.0
-
-        red, green, blue = [int(round(col * 255)) for col in colorsys.hsv_to_rgb(hue, saturation, 1)]
-        return red * 65536 + green * 256 + blue
+        return hsv_to_rgb(self.hue, self.saturation)
 
     def __repr__(self):
         return "<%s(%s,%s) duration %s, brightness %s>" % (
@@ -214,3 +286,136 @@ class SleepTransition(FlowTransition):
 
     def __repr__(self):
         return "<%s: duration %s>" % (self.__class__.__name__, self.duration)
+
+
+def _restore_transitions(properties):
+    """
+    Return the transitions that bring a bulb back to the color and brightness in its properties.
+
+    :param dict properties: The bulb's properties, as returned by
+                            :py:meth:`Bulb.get_properties()
+                            <yeelight.Bulb.get_properties()>`.
+
+    :returns: A list with a single transition, or an empty list if the
+              properties don't describe the color.
+    :rtype: list
+    """
+    try:
+        brightness = int(properties["bright"])
+        mode = properties["color_mode"]
+        if mode == "1":
+            rgb = int(properties["rgb"])
+            transition = RGBTransition(rgb >> 16 & 0xFF, rgb >> 8 & 0xFF, rgb & 0xFF, 50, brightness)
+        elif mode == "2":
+            transition = TemperatureTransition(int(properties["ct"]), 50, brightness)
+        elif mode == "3":
+            transition = HSVTransition(int(properties["hue"]), int(properties["sat"]), 50, brightness)
+        else:
+            return []
+    except (KeyError, TypeError, ValueError):
+        return []
+    return [transition]
+
+
+class FlowRunner(object):
+    def __init__(self, bulb, flow, size=_MAX_TRANSITIONS):
+        """
+        Run a flow of any length on a bulb.
+
+        Bulbs only accept flows of up to nine transitions, so the runner splits
+        longer flows into segments that fit, and starts each segment, from a
+        background thread, when the one before it ends. The segments are
+        scheduled from the start of the flow, rather than from each other, so
+        delays in sending one segment don't add up over the flow.
+
+        Don't create runners directly, use :py:meth:`Bulb.run_flow()
+        <yeelight.Bulb.run_flow()>`, which also makes :py:meth:`Bulb.stop_flow()
+        <yeelight.Bulb.stop_flow()>` cancel the runner.
+
+        :param yeelight.Bulb bulb: The bulb to run the flow on.
+        :param yeelight.Flow flow: The flow to run.
+        :param int size: The most transitions to send to the bulb at a time.
+        """
+        self.bulb = bulb
+        self.flow = flow
+        self.size = size
+        self.exception = None  # The exception that stopped the flow, if any.
+
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()  # Held while sending a segment.
+        self._thread = None
+
+    def start(self):
+        """
+        Start the first segment of the flow, and schedule the rest.
+
+        :raises BulbException: When the first segment could not be started.
+        """
+        if len(self.flow.transitions) <= self.size:
+            # The bulb can run the whole flow by itself.
+            self.bulb.start_flow(self.flow)
+            return
+
+        properties = None
+        if self.flow.count and self.flow.action is Action.recover:
+            properties = self.bulb.get_properties()
+
+        # Turn the bulb on once, rather than before every segment, so that the
+        # segments are sent on time.
+        self.bulb.ensure_on()
+        segments = self.flow._segments(self.size, properties)
+        segment, duration = next(segments)
+        start = time.monotonic()
+        self.bulb.send_command("start_cf", segment.params)
+
+        self._thread = threading.Thread(target=self._run, args=(segments, start + duration))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, segments, due):
+        """Start each of the segments when the one before it ends."""
+        for segment, duration in segments:
+            if self._cancelled.wait(max(0, due - time.monotonic())):
+                return
+
+            with self._lock:
+                if self._cancelled.is_set():
+                    return
+                try:
+                    self.bulb.send_command("start_cf", segment.params)
+                except Exception as ex:
+                    _LOGGER.debug("%s: Could not start the next flow segment: %s", self.bulb, ex)
+                    self.exception = ex
+                    return
+
+            due += duration
+
+    @property
+    def running(self):
+        """Whether there are still segments to start."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def cancel(self):
+        """
+        Stop starting segments.
+
+        If a segment is being sent, this waits until it has been, so that a
+        command sent afterwards (like ``stop_cf``) reaches the bulb after it.
+        The segment the bulb is running is not stopped.
+        """
+        self._cancelled.set()
+        with self._lock:
+            pass
+
+    def wait(self, timeout=None):
+        """
+        Wait until all the segments have been started, or the runner is cancelled.
+
+        :param float timeout: How many seconds to wait at most.
+
+        :returns: Whether the runner has finished.
+        :rtype: bool
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return not self.running
@@ -0,0 +1,115 @@
+"""Control many bulbs at once."""
+
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .main import Bulb, BulbException
+
+BulbResult = namedtuple("BulbResult", ["result", "error", "latency"])
+BulbResult.__doc__ = """
+The outcome of a :py:class:`BulbGroup` command on one of its bulbs.
+
+``result`` is what the bulb's method returned (or None if it failed),
+``error`` is the exception it raised (or None), and ``latency`` is how many
+seconds it took, or None if it didn't finish before the group's deadline.
+"""
+
+
+def _group_command(method):
+    """Return a :py:class:`BulbGroup` method that calls a :py:class:`Bulb <yeelight.Bulb>` method on every bulb."""
+
+    def wrapper(self, *args, **kwargs):
+        return self._call(method.__name__, *args, **kwargs)
+
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class BulbGroup(object):
+    def __init__(self, bulbs, timeout=5):
+        """
+        A group of bulbs, controlled together.
+
+        The group has the same command methods as :py:class:`Bulb
+        <yeelight.Bulb>`, which call the method on all the bulbs at the same
+        time, and return a dictionary of bulb: :py:class:`BulbResult` items::
+
+            >>> room = BulbGroup([Bulb("192.168.0.19"), Bulb("192.168.0.23")])
+            >>> room.set_rgb(255, 0, 0)
+            {<Bulb ...>: BulbResult(result='ok', error=None, latency=0.02),
+             <Bulb ...>: BulbResult(result=None, error=BulbException(...), latency=0.01)}
+
+        A command takes as long as the slowest bulb, and at most ``timeout``
+        seconds, after which the bulbs that haven't finished are reported as
+        failed. Each bulb has its own worker thread, so a bulb that hangs
+        doesn't hold up the others. A command that a bulb's worker hasn't
+        started by the deadline (because the bulb is still busy with an earlier
+        one) is cancelled, so it never reaches the bulb; one that has started
+        can't be stopped, and may still reach it.
+
+        :param list bulbs: The :py:class:`Bulb <yeelight.Bulb>` instances in
+                           the group.
+        :param float timeout: How many seconds to wait for all the bulbs to
+                              finish each command.
+        """
+        self.bulbs = list(bulbs)
+        self.timeout = timeout
+
+        self._executors = {bulb: ThreadPoolExecutor(max_workers=1) for bulb in self.bulbs}
+
+    def close(self):
+        """Stop the group's worker threads, once they have finished the commands in progress."""
+        for executor in self._executors.values():
+            executor.shutdown(wait=False)
+
+    def _call(self, name, *args, **kwargs):
+        """
+        Call a method on every bulb at the same time.
+
+        :param str name: The name of the bulb method to call.
+
+        :returns: A dictionary of bulb: :py:class:`BulbResult` items, in the
+                  order of the group's bulbs.
+        :rtype: dict
+        """
+
+        def run(bulb):
+            start = time.monotonic()
+            try:
+                result = getattr(bulb, name)(*args, **kwargs)
+            except Exception as ex:
+                return BulbResult(None, ex, time.monotonic() - start)
+            return BulbResult(result, None, time.monotonic() - start)
+
+        futures = [(bulb, self._executors[bulb].submit(run, bulb)) for bulb in self.bulbs]
+        wait([future for _, future in futures], timeout=self.timeout)
+
+        results = {}
+        for bulb, future in futures:
+            if future.done():
+                results[bulb] = future.result()
+            else:
+                # Don't send the command later, if the bulb hasn't started it yet.
+                future.cancel()
+                results[bulb] = BulbResult(None, BulbException("The bulb did not finish in time."), None)
+        return results
+
+    get_properties = _group_command(Bulb.get_properties)
+    send_command = _group_command(Bulb.send_command)
+    ensure_on = _group_command(Bulb.ensure_on)
+    set_color_temp = _group_command(Bulb.set_color_temp)
+    set_rgb = _group_command(Bulb.set_rgb)
+    set_adjust = _group_command(Bulb.set_adjust)
+    set_hsv = _group_command(Bulb.set_hsv)
+    set_brightness = _group_command(Bulb.set_brightness)
+    set_power_mode = _group_command(Bulb.set_power_mode)
+    turn_on = _group_command(Bulb.turn_on)
+    turn_off = _group_command(Bulb.turn_off)
+    toggle = _group_command(Bulb.toggle)
+    set_default = _group_command(Bulb.set_default)
+    set_name = _group_command(Bulb.set_name)
+    start_flow = _group_command(Bulb.start_flow)
+    stop_flow = _group_command(Bulb.stop_flow)
+    apply_state = _group_command(Bulb.apply_state)
@@ -1,17 +1,22 @@
-import colorsys
 import json
 import logging
+import numbers
 import os
+import select
 import socket
 import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from enum import Enum
 
-from future.utils import raise_from
-
+from .color import hsv_to_rgb, rgb_to_int
 from .decorator import decorator
 from .enums import PowerMode
-from .flow import Flow
-from .utils import _clamp
+from .flow import Flow, FlowRunner
+from .utils import _clamp, _LineDecoder, _TokenBucket
 
 if os.name == "nt":
     import win32api as fcntl
@@ -19,13 +24,16 @@ else:
     import fcntl
 
 
-try:
-    from urllib.parse import urlparse
-except ImportError:
-    from urlparse import urlparse
+from urllib.parse import urlparse
 
 _LOGGER = logging.getLogger(__name__)
 
+_DISCOVERY_MESSAGE = "\r\n".join(
+    ["M-SEARCH * HTTP/1.1", "HOST: 239.255.255.250:1982", 'MAN: "ssdp:discover"', "ST: wifi_bulb"]
+).encode()
+_DISCOVERY_RESEND_DELAY = 0.25  # Seconds before the first search is resent. Doubles every time.
+_DISCOVERY_MIN_QUIET = 0.25  # The fewest seconds without new bulbs before discovery stops early.
+
 _MODEL_SPECS = {
     "mono": {"color_temp": {"min": 2700, "max": 2700}},
     "mono1": {"color_temp": {"min": 2700, "max": 2700}},
@@ -41,15 +49,48 @@ _MODEL_SPECS = {
 }
 
 
-@decorator
-def _command(f, *args, **kw):
-    """A decorator that wraps a function and enables effects."""
+# Commands that only set state, so only the last one of a burst matters.
+_COALESCED_METHODS = ("set_ct_abx", "set_rgb", "set_hsv", "set_bright", "set_power")
+
+# Commands that should turn the bulb on first when ``auto_on`` is set.
+_AUTO_ON_METHODS = ("set_ct_abx", "set_rgb", "set_hsv", "set_bright", "start_cf")
+
+# Commands that are recorded by ``Bulb.batch()`` rather than sent immediately.
+_BATCHED_COMMANDS = ("set_rgb", "set_hsv", "set_color_temp", "set_brightness", "turn_on")
+
+_DEFAULT_PROPERTIES = [
+    "power",
+    "bright",
+    "ct",
+    "rgb",
+    "hue",
+    "sat",
+    "color_mode",
+    "flowing",
+    "delayoff",
+    "music_on",
+    "nl_br",
+    "active_mode",
+    "bg_power",
+    "bg_rgb",
+    "name",
+]
+
+
+def _build_command(f, *args, **kw):
+    """
+    Run a command method and return the method and params to send.
+
+    This applies the effect, duration and power mode parameters, and keeps the
+    music mode cache up to date, but does not send anything to the bulb.
+    """
     self = args[0]
     effect = kw.get("effect", self.effect)
     duration = kw.get("duration", self.duration)
     power_mode = kw.get("power_mode", self.power_mode)
 
     method, params = f(*args, **kw)
+    self._check_supported(method)
     if method in ["set_ct_abx", "set_rgb", "set_hsv", "set_bright", "set_power", "toggle"]:
         if self._music_mode:
             # Mapping calls to their properties.
@@ -75,6 +116,24 @@ def _command(f, *args, **kw):
         if method == "set_power" and params[0] == "on" and power_mode.value != PowerMode.LAST:
             params += [power_mode.value]
 
+    return method, params
+
+
+@decorator
+def _command(f, *args, **kw):
+    """A decorator that wraps a function and enables effects."""
+    self = args[0]
+    if self._batch is not None:
+        if f.__name__ in _BATCHED_COMMANDS:
+            self._batch.record(f, *args, **kw)
+            return
+        # Send what we have so far, so the commands are executed in order.
+        self._batch.flush()
+
+    method, params = _build_command(f, *args, **kw)
+    if method in _AUTO_ON_METHODS:
+        self.ensure_on()
+
     result = self.send_command(method, params).get("result", [])
     if result:
         return result[0]
@@ -90,9 +149,12 @@ def get_ip_address(ifname):
 
     """
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    return socket.inet_ntoa(
-        fcntl.ioctl(s.fileno(), 0x8915, struct.pack("256s", bytes(ifname[:15], "utf-8")))[20:24]
-    )  # SIOCGIFADDR
+    try:
+        return socket.inet_ntoa(
+            fcntl.ioctl(s.fileno(), 0x8915, struct.pack("256s", bytes(ifname[:15], "utf-8")))[20:24]
+        )  # SIOCGIFADDR
+    finally:
+        s.close()
 
 
 def discover_bulbs(timeout=2, interface=False):
@@ -101,46 +163,176 @@ def discover_bulbs(timeout=2, interface=False):
 
     :param int timeout: How many seconds to wait for replies. Discovery will
                         always take exactly this long to run, as it can't know
-                        when all the bulbs have finished responding.
+                        when all the bulbs have finished responding. To return
+                        as soon as the bulbs have responded, use
+                        :py:func:`discover_bulbs_iter() <discover_bulbs_iter>`.
 
     :param string interface: The interface that should be used for multicast packets.
                              Note: it *has* to have a valid IPv4 address. IPv6-only
                              interfaces are not supported (at the moment).
                              The default one will be used if this is not specified.
+                             This can also be a list of interfaces, or ``"all"``
+                             for every interface with an IPv4 address, which are
+                             all searched at the same time.
 
     :returns: A list of dictionaries, containing the ip, port and capabilities
               of each of the bulbs in the network.
     """
-    msg = "\r\n".join(["M-SEARCH * HTTP/1.1", "HOST: 239.255.255.250:1982", 'MAN: "ssdp:discover"', "ST: wifi_bulb"])
-
-    # Set up UDP socket
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
-    if interface:
-        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(get_ip_address(interface)))
-    s.settimeout(timeout)
-    s.sendto(msg.encode(), ("239.255.255.250", 1982))
-
-    bulbs = []
-    bulb_ips = set()
-    while True:
-        try:
-            data, addr = s.recvfrom(65507)
-        except socket.timeout:
-            break
+    return list(discover_bulbs_iter(timeout, interface, stop_when_quiet=False))
+
+
+def discover_bulbs_iter(timeout=2, interface=False, expected=None, stop_when_quiet=True):
+    """
+    Discover the bulbs in the local network, yielding each one as soon as it responds.
+
+    The search is sent again a few times, at increasing intervals, in case
+    the bulbs missed it (or we missed their responses). Discovery stops when
+    the ``expected`` bulbs have responded, when no new bulbs have responded
+    for a while, or after ``timeout`` seconds, whichever comes first::
+
+        >>> for bulb in discover_bulbs_iter(expected={"0x0000000002dfb19a"}):
+        ...     print(bulb["ip"])
+        192.168.0.19
+
+    :param int timeout: The most seconds to wait for replies.
+    :param string interface: The interface (or list of interfaces, or
+                             ``"all"``) that should be used for multicast
+                             packets. See :py:func:`discover_bulbs()
+                             <discover_bulbs>`.
+    :param expected: Either the number of bulbs to wait for, or a collection of
+                     the IDs of the bulbs to wait for.
+    :param bool stop_when_quiet: Whether to stop once no new bulbs have
+                                 responded for a while. The quiet period adapts
+                                 to how long the bulbs took to respond so far.
+
+    :returns: An iterator of dictionaries, containing the ip, port and
+              capabilities of each of the bulbs in the network.
+    """
+    # Set up a UDP socket for each interface, and search on all of them at once.
+    sockets = []
+    for address in _interface_addresses(interface):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
+        if address:
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(address))
+        sockets.append(s)
+
+    if expected is not None and not isinstance(expected, int):
+        expected = set(expected)
+
+    seen = set()  # The IDs (or addresses) of the bulbs that have responded.
+    start = last_sent = last_found = time.monotonic()
+    deadline = start + timeout
+    resend_delay = _DISCOVERY_RESEND_DELAY
+    next_send = start
+    slowest = 0  # The longest a bulb has taken to respond to a search.
+
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= next_send:
+                for s in sockets:
+                    s.sendto(_DISCOVERY_MESSAGE, ("239.255.255.250", 1982))
+                last_sent = now
+                next_send = now + resend_delay
+                resend_delay *= 2
+
+            wake_up = min(deadline, next_send)
+            if stop_when_quiet and seen:
+                quiet_period = max(_DISCOVERY_MIN_QUIET, 2 * slowest)
+                wake_up = min(wake_up, max(last_found, last_sent) + quiet_period)
+                if now >= wake_up:
+                    break
+            if now >= deadline:
+                break
+
+            readable, _, _ = select.select(sockets, [], [], max(0, wake_up - now))
+            for s in readable:
+                data, addr = s.recvfrom(65507)
+                bulb = _parse_capabilities(_parse_headers(data))
+                if bulb is None:
+                    continue
+
+                # The same bulb may respond on more than one interface.
+                key = bulb["capabilities"].get("id") or (bulb["ip"], bulb["port"])
+                if key in seen:
+                    continue
+
+                seen.add(key)
+                last_found = time.monotonic()
+                slowest = max(slowest, last_found - last_sent)
+                yield bulb
+
+            if isinstance(expected, int) and len(seen) >= expected:
+                break
+            if isinstance(expected, set) and expected <= seen:
+                break
+    finally:
+        for s in sockets:
+            s.close()
 
-        capabilities = dict([x.strip("\r").split(": ") for x in data.decode().split("\n") if ":" in x])
-        parsed_url = urlparse(capabilities["Location"])
 
-        bulb_ip = (parsed_url.hostname, parsed_url.port)
-        if bulb_ip in bulb_ips:
-            continue
+def _interface_addresses(interface):
+    """
+    Return the IPv4 addresses to send discovery searches from.
+
+    :param interface: An interface name, a list of them, ``"all"`` for all the
+                      interfaces with an IPv4 address (except loopback), or
+                      False for the default interface.
+
+    :returns: A list of IPv4 addresses, where None means the default interface.
+    """
+    if not interface:
+        return [None]
+
+    if interface == "all":
+        addresses = []
+        for _, name in socket.if_nameindex():
+            try:
+                address = get_ip_address(name)
+            except (IOError, OSError):
+                # The interface doesn't have an IPv4 address.
+                continue
+            if not address.startswith("127.") and address not in addresses:
+                addresses.append(address)
+        return addresses or [None]
+
+    if isinstance(interface, str):
+        interface = [interface]
+    return [get_ip_address(name) for name in interface]
 
-        capabilities = {key: value for key, value in capabilities.items() if key.islower()}
-        bulbs.append({"ip": bulb_ip[0], "port": bulb_ip[1], "capabilities": capabilities})
-        bulb_ips.add(bulb_ip)
 
-    return bulbs
+def _parse_headers(data):
+    """
+    Parse the headers of an SSDP message sent by a bulb.
+
+    :param bytes data: The message.
+
+    :returns: A dictionary of header: value items.
+    """
+    headers = {}
+    for line in data.decode("utf8", "replace").split("\n"):
+        key, colon, value = line.partition(":")
+        if colon:
+            headers[key.strip()] = value.strip()
+    return headers
+
+
+def _parse_capabilities(headers):
+    """
+    Return a bulb's address and capabilities from the headers of its SSDP message.
+
+    :param dict headers: The headers of a discovery response or advertisement.
+
+    :returns: A dictionary containing the ip, port and capabilities of the
+              bulb, or None if the message isn't from a bulb.
+    """
+    if "Location" not in headers:
+        return None
+
+    parsed_url = urlparse(headers["Location"])
+    capabilities = {key: value for key, value in headers.items() if key.islower()}
+    return {"ip": parsed_url.hostname, "port": parsed_url.port, "capabilities": capabilities}
 
 
 class BulbException(Exception):
@@ -154,6 +346,180 @@ class BulbException(Exception):
     pass
 
 
+class RateLimitException(BulbException):
+    """
+    The rate limit exception.
+
+    This exception is raised when sending a command would exceed the bulb's
+    ``rate_limit``, and the bulb is set to not wait for it.
+    """
+
+    pass
+
+
+class _CommandFuture(Future):
+    """A future for a command's response, which reads the response from the bulb when waited on."""
+
+    def __init__(self, bulb, method):
+        super(_CommandFuture, self).__init__()
+        self._bulb = bulb
+        self.method = method
+
+    def result(self, timeout=None):
+        return super(_CommandFuture, self).result(self._wait(timeout))
+
+    def exception(self, timeout=None):
+        return super(_CommandFuture, self).exception(self._wait(timeout))
+
+    def _wait(self, timeout):
+        """Read responses for up to ``timeout`` seconds, and return how much of the timeout is left."""
+        start = time.monotonic()
+        self._bulb._wait_for(self, timeout)
+        if timeout is None:
+            return None
+        return max(0, timeout - (time.monotonic() - start))
+
+
+def _shutdown_socket(sock):
+    """Shut a socket down, waking up any thread that is blocked reading from it."""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        # The socket is not connected.
+        pass
+
+
+def _chain_future(source, target):
+    """Resolve the target future with the outcome of the source future, when it's done."""
+
+    def copy(future):
+        if future.exception() is not None:
+            target.set_exception(future.exception())
+        else:
+            target.set_result(future.result())
+
+    source.add_done_callback(copy)
+
+
+class _Batch(object):
+    """The state changes recorded by :py:meth:`Bulb.batch() <yeelight.Bulb.batch()>`."""
+
+    def __init__(self, bulb):
+        self.bulb = bulb
+        self.reset()
+
+    def reset(self):
+        """Forget everything that was recorded."""
+        self.color = None  # A (flow mode, value) tuple, or ("hsv", hue, saturation).
+        self.brightness = None
+        self.power = False
+        self.power_mode = self.bulb.power_mode
+        self.effect = self.bulb.effect
+        self.duration = self.bulb.duration
+
+    def record(self, f, *args, **kw):
+        """Record a call to one of the bulb's command methods."""
+        method, params = f(*args, **kw)
+        self.effect = kw.get("effect", self.effect)
+        self.duration = kw.get("duration", self.duration)
+
+        if method == "set_rgb":
+            self.color = (1, params[0])
+        elif method == "set_ct_abx":
+            self.color = (2, params[0])
+        elif method == "set_hsv":
+            self.color = ("hsv", params[0], params[1])
+        elif method == "start_cf":
+            # ``set_hsv`` with a value uses a flow with a single RGB transition.
+            _, _, rgb, brightness = [int(value) for value in params[2].split(",")]
+            self.color = (1, rgb)
+            self.brightness = brightness
+        elif method == "set_bright":
+            self.brightness = params[0]
+        elif method == "set_power":
+            self.power = True
+            self.power_mode = kw.get("power_mode", self.power_mode)
+
+    def commands(self):
+        """
+        Return the fewest commands that apply the recorded changes.
+
+        :returns: A list of (method, params) tuples.
+        :rtype: list
+        """
+        bulb = self.bulb
+        effect_params = [self.effect, self.duration]
+        turn_on = self.power or (
+            bulb.auto_on and not bulb.music_mode and (self.color is not None or self.brightness is not None)
+        )
+        commands = []
+
+        if turn_on and (self.power_mode not in (None, PowerMode.LAST) or not self.color):
+            # Only set_power can select a power mode, and it's the only way to
+            # turn the bulb on without also setting a color.
+            params = ["on"] + effect_params
+            if self.power_mode not in (None, PowerMode.LAST):
+                params.append(self.power_mode.value)
+            commands.append(("set_power", params))
+            turn_on = False
+
+        color = self.color
+        if color and color[0] == "hsv" and (turn_on or self.brightness is not None):
+            # Flows can't use HSV, so convert it like set_hsv does.
+            color = (1, hsv_to_rgb(color[1], color[2]))
+
+        if color and (turn_on or self.brightness is not None):
+            # A single transition sets both the color and the brightness.
+            duration = 50 if self.effect == "sudden" else max(50, self.duration)
+            brightness = -1 if self.brightness is None else self.brightness
+            flow = [1, Flow.actions.stay.value, "%s, %s, %s, %s" % (duration, color[0], color[1], brightness)]
+            if turn_on:
+                # set_scene turns the bulb on, if it's off, before running the flow.
+                commands.append(("set_scene", ["cf"] + flow))
+            else:
+                commands.append(("start_cf", flow))
+        elif color:
+            method = {1: "set_rgb", 2: "set_ct_abx", "hsv": "set_hsv"}[color[0]]
+            commands.append((method, list(color[1:]) + effect_params))
+        elif self.brightness is not None:
+            commands.append(("set_bright", [self.brightness] + effect_params))
+
+        return commands
+
+    def flush(self):
+        """Send the recorded changes to the bulb, and forget them."""
+        commands = self.commands()
+        bulb = self.bulb
+        if bulb.music_mode:
+            # Keep the music mode cache up to date.
+            if self.power or any(method == "set_scene" for method, _ in commands):
+                bulb._last_properties["power"] = "on"
+            if self.brightness is not None:
+                bulb._last_properties["bright"] = self.brightness
+            if self.color and self.color[0] == "hsv":
+                bulb._last_properties.update({"hue": self.color[1], "sat": self.color[2]})
+            elif self.color:
+                bulb._last_properties[{1: "rgb", 2: "ct"}[self.color[0]]] = self.color[1]
+
+        self.reset()
+        sent = time.monotonic()
+        futures = [bulb.submit_command(method, params) for method, params in commands]
+        for (method, params), future in zip(commands, futures):
+            bulb._wait_for_response(future)
+            if not bulb.music_mode:
+                bulb._track_power(method, params, sent)
+
+
+StreamStats = namedtuple("StreamStats", ["sent", "dropped", "fps", "jitter"])
+StreamStats.__doc__ = """
+Statistics about a stream of frames sent with :py:meth:`Bulb.stream() <yeelight.Bulb.stream()>`.
+
+``sent`` and ``dropped`` are the number of frames that were sent and dropped,
+``fps`` is the achieved rate of frames per second, and ``jitter`` is the
+standard deviation of how late the frames were sent, in seconds.
+"""
+
+
 class BulbType(Enum):
     """
     The bulb's type.
@@ -172,7 +538,18 @@ class BulbType(Enum):
 
 class Bulb(object):
     def __init__(
-        self, ip, port=55443, effect="smooth", duration=300, auto_on=False, power_mode=PowerMode.LAST, model=None
+        self,
+        ip,
+        port=55443,
+        effect="smooth",
+        duration=300,
+        auto_on=False,
+        power_mode=PowerMode.LAST,
+        model=None,
+        rate_limit=None,
+        rate_limit_wait=True,
+        coalesce=False,
+        power_ttl=0,
     ):
         """
         The main controller class of a physical YeeLight bulb.
@@ -198,6 +575,40 @@ class Bulb(object):
                              "mono", etc). The setting is used to enable model
                              specific features (e.g. a particular color
                              temperature range).
+        :param int rate_limit:
+                             The maximum number of commands to send to the bulb
+                             per minute (the bulbs allow 60), or None for no
+                             limit. Bulbs drop connections that exceed their
+                             quota, so this throttles commands on our side
+                             instead. Commands sent in music mode are exempt.
+        :param bool rate_limit_wait:
+                             What to do with a command that would exceed the
+                             rate limit. If True, wait until it can be sent,
+                             otherwise raise a :py:class:`RateLimitException
+                             <yeelight.RateLimitException>`.
+        :param bool coalesce:
+                             Whether to coalesce commands that set state (like
+                             brightness or color). While such a command is
+                             waiting for the bulb's response, only the last of
+                             any further commands of the same kind is kept, and
+                             it is sent when the response arrives, or before
+                             a command of another kind, whichever comes first,
+                             so commands never overtake each other. The
+                             commands that were skipped get the same result as
+                             the one that was sent. This is useful when many
+                             threads, or :py:meth:`submit_command()
+                             <yeelight.Bulb.submit_command()>`, send commands
+                             faster than the bulb can respond (e.g. from a
+                             slider).
+        :param float power_ttl:
+                             How many seconds the bulb's power state is trusted
+                             for, after we last learned it. With ``auto_on``,
+                             the bulb is only queried before a command if its
+                             power state is older than this. The power state is
+                             learned from the bulb's properties and
+                             notifications, and from our own ``turn_on()``,
+                             ``turn_off()`` and ``toggle()`` calls. By default,
+                             the bulb is queried before every command.
 
         """
         self._ip = ip
@@ -208,11 +619,75 @@ class Bulb(object):
         self.auto_on = auto_on
         self.power_mode = power_mode
         self.model = model
+        self.supported_methods = None  # The methods the bulb supports, if we know them.
+        self.rate_limit_wait = rate_limit_wait
+        self.coalesce = coalesce
+        self.power_ttl = power_ttl
 
+        self._rate_limiter = _TokenBucket(rate_limit) if rate_limit else None
         self.__cmd_id = 0  # The last command id we used.
         self._last_properties = {}  # The last set of properties we've seen.
+        self._property_times = {}  # When we last learned each property, from ``time.monotonic()``.
         self._music_mode = False  # Whether we're currently in music mode.
         self.__socket = None  # The socket we use to communicate.
+        self._decoder = _LineDecoder()  # Decodes the lines the bulb sends us over the socket.
+        self._pending = OrderedDict()  # Futures of the commands awaiting a response, by ID.
+        self._held = {}  # The (params, future) of the commands held back by coalescing, by method.
+        self._batch_local = threading.local()  # The changes recorded by ``batch()``, per thread.
+        self._flow_runner = None  # The runner of the last flow started with ``run_flow()``.
+        self._write_lock = threading.RLock()  # Guards writing to the socket and the pending commands.
+        self._read_lock = threading.Lock()  # Makes sure only one thread reads from the socket.
+        self._listener = None  # The thread reading notifications, if we're listening.
+        self._listener_stop = threading.Event()  # Set to stop the listener.
+        self._listener_callback = None  # Called with every notification's properties.
+        self._callback_executor = None  # Runs the listener callback, outside the reading thread.
+
+    @property
+    def _batch(self):
+        """The changes the current thread is recording with ``batch()``, or None if it isn't recording."""
+        return getattr(self._batch_local, "batch", None)
+
+    @_batch.setter
+    def _batch(self, batch):
+        self._batch_local.batch = batch
+
+    @classmethod
+    def from_discovery(cls, bulb, **kwargs):
+        """
+        Create a bulb from a discovery result.
+
+        The bulb's model is set from the result, and the methods the bulb
+        reported supporting are stored in ``supported_methods``. Calling a
+        method the bulb doesn't support raises a ``BulbException`` right away,
+        without sending anything to the bulb::
+
+            >>> bulb = Bulb.from_discovery(discover_bulbs()[0], effect="sudden")
+            >>> bulb.set_hsv(320, 100)
+            BulbException: The bulb does not support the set_hsv method.
+
+        :param dict bulb: One of the dictionaries :py:func:`discover_bulbs()
+                          <yeelight.discover_bulbs>` returns.
+        :param kwargs: Any other arguments to pass to the constructor.
+
+        :rtype: yeelight.Bulb
+        """
+        capabilities = bulb.get("capabilities", {})
+        kwargs.setdefault("model", capabilities.get("model"))
+        instance = cls(bulb["ip"], bulb.get("port", 55443), **kwargs)
+        if capabilities.get("support"):
+            instance.supported_methods = frozenset(capabilities["support"].split())
+        return instance
+
+    def _check_supported(self, method):
+        """
+        Make sure the bulb supports a method, if we know which methods it supports.
+
+        :param str method: The name of the method.
+
+        :raises BulbException: When the bulb doesn't support the method.
+        """
+        if self.supported_methods is not None and method not in self.supported_methods:
+            raise BulbException("The bulb does not support the %s method." % method)
 
     @property
     def _cmd_id(self):
@@ -227,33 +702,125 @@ class Bulb(object):
     @property
     def _socket(self):
         """Return, optionally creating, the communication socket."""
-        if self.__socket is None:
-            self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.__socket.settimeout(5)
-            self.__socket.connect((self._ip, self._port))
-        return self.__socket
+        with self._write_lock:
+            if self.__socket is None:
+                self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.__socket.settimeout(5)
+                self.__socket.connect((self._ip, self._port))
+                self._decoder = _LineDecoder()
+            return self.__socket
 
     def ensure_on(self):
         """Turn the bulb on if it is off."""
         if self._music_mode is True or self.auto_on is False:
             return
 
-        self.get_properties()
+        if not self._is_fresh("power", self.power_ttl):
+            self.get_properties()
 
-        if self._last_properties["power"] != "on":
+        if self._last_properties.get("power") != "on":
             self.turn_on()
 
+    def _is_fresh(self, name, max_age):
+        """
+        Return whether we learned a property's value at most ``max_age`` seconds ago.
+
+        :param str name: The name of the property.
+        :param float max_age: How old the value can be, in seconds.
+
+        :rtype: bool
+        """
+        learned = self._property_times.get(name)
+        return bool(max_age) and learned is not None and time.monotonic() - learned <= max_age
+
+    def _update_properties(self, properties):
+        """
+        Update ``last_properties`` with values we just learned.
+
+        :param dict properties: The new values, by property name.
+        """
+        now = time.monotonic()
+        self._last_properties.update(properties)
+        for name in properties:
+            self._property_times[name] = now
+
+        if self._last_properties.get("power") == "off":
+            cb = "0"
+        elif self._last_properties.get("active_mode") == "1":
+            # Nightlight mode.
+            cb = self._last_properties.get("nl_br")
+        else:
+            cb = self._last_properties.get("bright")
+        self._last_properties["current_brightness"] = cb
+
+    def _track_power(self, method, params, sent):
+        """
+        Update the power state after a command succeeded.
+
+        :param str method: The method that was sent.
+        :param list params: Its parameters.
+        :param float sent: When the command was sent, from ``time.monotonic()``.
+        """
+        if method == "set_power":
+            self._update_properties({"power": params[0]})
+        elif method == "set_scene":
+            # Scenes turn the bulb on.
+            self._update_properties({"power": "on"})
+        elif method == "toggle":
+            if self._property_times.get("power", sent) > sent:
+                # The bulb has already notified us of its new power state.
+                return
+            power = self._last_properties.get("power")
+            if power in ("on", "off") and self._is_fresh("power", self.power_ttl):
+                self._update_properties({"power": "off" if power == "on" else "on"})
+            else:
+                # We don't know what the bulb was toggled from.
+                self._property_times.pop("power", None)
+
     @property
     def last_properties(self):
         """
         The last properties we've seen the bulb have.
 
-        This might potentially be out of date, as there's no background listener
-        for the bulb's notifications. To update it, call
+        This might potentially be out of date, unless the bulb is being
+        listened to with :py:meth:`start_listening
+        <yeelight.Bulb.start_listening()>`, as otherwise notifications are only
+        read while waiting for a command's response. To update it, call
         :py:meth:`get_properties <yeelight.Bulb.get_properties()>`.
         """
         return self._last_properties
 
+    @property
+    def rate_limit_remaining(self):
+        """
+        The number of commands that can be sent right now without exceeding the rate limit.
+
+        :rtype: int
+        :return: The remaining number of commands, or None if there is no rate
+                 limit.
+        """
+        if self._rate_limiter is None:
+            return None
+        return self._rate_limiter.remaining
+
+    def _throttle_delay(self):
+        """
+        Take a command from the rate limit quota.
+
+        :raises RateLimitException: When the command would exceed the rate limit
+                                    and we shouldn't wait.
+        :returns: The number of seconds to wait before sending the command.
+        """
+        if self._rate_limiter is None or self._music_mode:
+            return 0
+
+        delay = self._rate_limiter.reserve(self.rate_limit_wait)
+        if delay is None:
+            raise RateLimitException(
+                "Sending this command would exceed the rate limit of %s commands per minute." % self._rate_limiter.quota
+            )
+        return delay
+
     @property
     def bulb_type(self):
         """
@@ -291,37 +858,27 @@ class Bulb(object):
         """
         return self._music_mode
 
-    def get_properties(
-        self,
-        requested_properties=[
-            "power",
-            "bright",
-            "ct",
-            "rgb",
-            "hue",
-            "sat",
-            "color_mode",
-            "flowing",
-            "delayoff",
-            "music_on",
-            "nl_br",
-            "active_mode",
-            "bg_power",
-            "bg_rgb",
-            "name",
-        ],
-    ):
+    def get_properties(self, requested_properties=_DEFAULT_PROPERTIES, max_age=None):
         """
         Retrieve and return the properties of the bulb.
 
         This method also updates ``last_properties`` when it is called.
 
+        The properties we learn (from the bulb's responses and notifications)
+        are cached. If ``max_age`` is given, only the requested properties we
+        learned more than ``max_age`` seconds ago are queried, and if there are
+        none, the bulb isn't queried at all::
+
+            >>> bulb.get_properties(max_age=5)
+
         The ``current_brightness`` property is calculated by the library (i.e. not returned
         by the bulb), and indicates the current brightness of the lamp, aware of night light
         mode. It is 0 if the lamp is off, and None if it is unknown.
 
         :param list requested_properties: The list of properties to request from the bulb.
                                           By default, this does not include ``flow_params``.
+        :param float max_age: How many seconds old the cached properties can
+                              be. By default, all the properties are queried.
 
         :returns: A dictionary of param: value items.
         :rtype: dict
@@ -331,22 +888,168 @@ class Bulb(object):
         if self._music_mode:
             return self._last_properties
 
-        response = self.send_command("get_prop", requested_properties)
+        stale = self._stale_properties(requested_properties, max_age)
+        if not stale:
+            return self._cached_properties(requested_properties)
+
+        response = self.send_command("get_prop", stale)
+        self._store_properties(stale, response)
+        return self._cached_properties(requested_properties)
+
+    def _stale_properties(self, requested_properties, max_age):
+        """
+        Return the properties that need to be queried from the bulb.
+
+        :param list requested_properties: The properties that were requested.
+        :param float max_age: How many seconds old the cached properties can
+                              be, or None to query all of them.
+
+        :rtype: list
+        """
+        if max_age is None:
+            return list(requested_properties)
+        return [name for name in requested_properties if not self._is_fresh(name, max_age)]
+
+    def _cached_properties(self, requested_properties):
+        """
+        Return the requested properties from ``last_properties``, with ``current_brightness``.
+
+        :param list requested_properties: The properties that were requested.
+
+        :rtype: dict
+        """
+        properties = {name: self._last_properties.get(name) for name in requested_properties}
+        properties["current_brightness"] = self._last_properties.get("current_brightness")
+        return properties
+
+    def _store_properties(self, requested_properties, response):
+        """
+        Update ``last_properties`` from a ``get_prop`` response.
+
+        :param list requested_properties: The properties that were requested.
+        :param dict response: The bulb's response to the ``get_prop`` command.
+
+        :returns: The updated properties.
+        :rtype: dict
+        """
         properties = response["result"]
         properties = [x if x else None for x in properties]
 
-        self._last_properties = dict(zip(requested_properties, properties))
+        self._update_properties(dict(zip(requested_properties, properties)))
+        return self._cached_properties(requested_properties)
 
-        if self._last_properties.get("power") == "off":
-            cb = "0"
-        elif self._last_properties.get("active_mode") == "1":
-            # Nightlight mode.
-            cb = self._last_properties.get("nl_br")
+    def submit_command(self, method, params=None):
+        """
+        Send a command to the bulb without waiting for the response.
+
+        This allows pipelining commands, i.e. sending several of them back to
+        back and then collecting their responses, which are matched to the
+        commands by their IDs. The response is read from the bulb when the
+        returned future's ``result()`` is called.
+
+        Example::
+
+        >>> futures = [bulb.submit_command("set_bright", [10]), bulb.submit_command("set_ct_abx", [2700])]
+        >>> [future.result() for future in futures]
+
+        :param str method:  The name of the method to send.
+        :param list params: The list of parameters for the method.
+
+        :raises BulbException: When the command could not be sent, or the
+                               bulb doesn't support it.
+        :raises RateLimitException: When the command would exceed the rate
+                                    limit and ``rate_limit_wait`` is False.
+        :returns: A future that will contain the response from the bulb, or
+                  raise a ``BulbException`` when the bulb indicates an error
+                  condition.
+        :rtype: concurrent.futures.Future
+        """
+        self._check_supported(method)
+        future = _CommandFuture(self, method)
+
+        with self._write_lock:
+            # Only the newest command can be held back.
+            newest = set(self._held) <= {method}
+            if self.coalesce and method in _COALESCED_METHODS and self._in_flight(method) and newest:
+                # Hold the command back until the one in flight is done, replacing
+                # any command that was already being held back.
+                held = self._held.get(method)
+                self._held[method] = (params, future)
+                if held is not None:
+                    _LOGGER.debug("%s: Coalescing %s %s into %s", self, method, held[0], params)
+                    _chain_future(future, held[1])
+                return future
+
+            # Send the command held back before this one, to keep the commands
+            # in order.
+            held, self._held = list(self._held.items()), {}
+
+        for held_method, (held_params, held_future) in held:
+            try:
+                time.sleep(self._throttle_delay())
+            except RateLimitException as ex:
+                held_future.set_exception(ex)
+                continue
+            self._write_held(held_method, held_params, held_future)
+
+        time.sleep(self._throttle_delay())
+
+        with self._write_lock:
+            self._write_command(method, params, future)
+
+        return future
+
+    def _write_command(self, method, params, future):
+        """Write a command to the socket, and wait for the response with the given future."""
+        with self._write_lock:
+            command = {"id": self._cmd_id, "method": method, "params": params}
+
+            _LOGGER.debug("%s > %s", self, command)
+
+            try:
+                self._socket.send((json.dumps(command) + "\r\n").encode("utf8"))
+            except socket.error as ex:
+                # Some error occurred, remove this socket in hopes that we can later
+                # create a new one.
+                self._close_socket()
+                raise BulbException("A socket error occurred when sending the command.") from ex
+
+            if self._music_mode:
+                # We're in music mode, nothing else will happen.
+                future.set_result({"result": ["ok"]})
+            else:
+                self._pending[command["id"]] = future
+
+    def _in_flight(self, method):
+        """Return whether a command with the given method is waiting for a response."""
+        return any(future.method == method for future in self._pending.values())
+
+    def _send_held(self, method):
+        """Send the command that was held back for the given method, if there is one."""
+        with self._write_lock:
+            if method not in self._held or self._in_flight(method):
+                return
+            params, future = self._held.pop(method)
+
+        try:
+            delay = self._throttle_delay()
+        except RateLimitException as ex:
+            future.set_exception(ex)
+            return
+
+        if delay:
+            timer = threading.Timer(delay, self._write_held, (method, params, future))
+            timer.daemon = True
+            timer.start()
         else:
-            cb = self._last_properties.get("bright")
-        self._last_properties["current_brightness"] = cb
+            self._write_held(method, params, future)
 
-        return self._last_properties
+    def _write_held(self, method, params, future):
+        """Write a command that was held back, failing its future if it can't be sent."""
+        try:
+            self._write_command(method, params, future)
+        except BulbException as ex:
+            future.set_exception(ex)
 
     def send_command(self, method, params=None):
         """
@@ -358,56 +1061,361 @@ class Bulb(object):
         :raises BulbException: When the bulb indicates an error condition.
         :returns: The response from the bulb.
         """
-        command = {"id": self._cmd_id, "method": method, "params": params}
+        sent = time.monotonic()
+        response = self._wait_for_response(self.submit_command(method, params))
 
-        _LOGGER.debug("%s > %s", self, command)
+        if not self._music_mode:
+            # In music mode, the cache is updated when the command is built.
+            self._track_power(method, params, sent)
+        return response
 
+    def _wait_for_response(self, future):
+        """Wait for the response to a submitted command, and give up on it if it takes too long."""
         try:
-            self._socket.send((json.dumps(command) + "\r\n").encode("utf8"))
-        except socket.error as ex:
-            # Some error occurred, remove this socket in hopes that we can later
-            # create a new one.
-            self.__socket.close()
-            self.__socket = None
-            raise_from(BulbException("A socket error occurred when sending the command."), ex)
+            return future.result(5)
+        except FutureTimeoutError:
+            self._forget(future)
+            raise BulbException("The bulb did not respond to the command.")
 
-        if self._music_mode:
-            # We're in music mode, nothing else will happen.
-            return {"result": ["ok"]}
+    def start_listening(self, callback=None):
+        """
+        Start listening for the bulb's notifications in a background thread.
+
+        While listening, the thread reads everything the bulb sends, so
+        ``last_properties`` is updated as soon as the bulb notifies us of a
+        change (e.g. because it was switched off from the wall or the app), and
+        commands waiting for a response are woken up by the thread. If the
+        connection is lost, the thread reconnects to the bulb.
+
+        Calling this while already listening only replaces the callback.
+
+        :param callable callback: A function that will be called with a
+                                  dictionary of the properties that changed
+                                  on every notification. It's called from a
+                                  separate thread, in the order of the
+                                  notifications, so it can send commands to
+                                  the bulb.
+        """
+        self._listener_callback = callback
+        if self._callback_executor is None:
+            self._callback_executor = ThreadPoolExecutor(max_workers=1)
+        if self._listener is not None:
+            return
+
+        self._listener_stop.clear()
+        self._listener = threading.Thread(target=self._listen, name="yeelight-listener-%s" % self._ip)
+        self._listener.daemon = True
+        self._listener.start()
+
+    def stop_listening(self):
+        """Stop listening for the bulb's notifications."""
+        listener, self._listener = self._listener, None
+        if listener is None:
+            return
+
+        self._listener_stop.set()
+        listener.join()
+
+        executor, self._callback_executor = self._callback_executor, None
+        executor.shutdown(wait=False)
+
+    def _listen(self):
+        """Read from the bulb until we're told to stop."""
+        while not self._listener_stop.is_set():
+            if self._music_mode:
+                # There's nothing to read in music mode.
+                self._listener_stop.wait(1)
+                continue
 
-        # The bulb will send us updates on its state in addition to responses,
-        # so we want to make sure that we read until we see an actual response.
-        response = None
-        while response is None:
             try:
-                data = self._socket.recv(16 * 1024)
+                self._socket
             except socket.error:
-                # An error occured, let's close and abort...
-                self.__socket.close()
-                self.__socket = None
-                response = {"error": "Bulb closed the connection."}
-                break
+                self._close_socket()
+                # Wait a bit before trying to reconnect.
+                self._listener_stop.wait(1)
+                continue
+
+            with self._read_lock:
+                self._read_responses()
+
+    def _wait_for(self, future, timeout=None):
+        """Read responses from the bulb until the given future is resolved, or the timeout runs out."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not future.done() and self._listener is None and not self._music_mode:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+            if not self._read_lock.acquire(timeout=-1 if remaining is None else remaining):
+                return
+            try:
+                if not future.done():
+                    self._read_responses(remaining)
+            finally:
+                self._read_lock.release()
 
-            for line in data.split(b"\r\n"):
-                if not line:
-                    continue
+    def _read_responses(self, timeout=None):
+        """
+        Read from the bulb once, and handle the responses and notifications received.
 
-                try:
-                    line = json.loads(line.decode("utf8"))
-                    _LOGGER.debug("%s < %s", self, line)
-                except ValueError:
-                    line = {"result": ["invalid command"]}
+        :param float timeout: The most seconds to wait for the bulb to send
+                              something. Unlike the socket's own timeout,
+                              running out of it leaves the connection open.
+        """
+        with self._write_lock:
+            if self._music_mode:
+                # The bulb doesn't send anything in music mode.
+                return
+            sock = self._socket
+        try:
+            data = self._recv(sock, timeout)
+            if not data:
+                raise socket.error("Connection closed.")
+        except socket.timeout:
+            if self._listener is not None or timeout is not None:
+                # The bulb just has nothing to say, the listener (or whoever is
+                # waiting) will try again.
+                return
+            self._close_socket(sock)
+            sock.close()
+            return
+        except socket.error:
+            # An error occured, let's close and abort...
+            self._close_socket(sock)
+            sock.close()
+            return
+
+        for line in self._decoder.feed(data):
+            _LOGGER.debug("%s < %s", self, line)
 
-                if line.get("method") != "props":
-                    # This is probably the response we want.
-                    response = line
-                else:
-                    self._last_properties.update(line["params"])
+            if line.get("method") == "props":
+                self._update_properties(line["params"])
+                self._notify(line["params"])
+            else:
+                self._resolve(line)
 
-        if "error" in response:
-            raise BulbException(response["error"])
+    @staticmethod
+    def _recv(sock, timeout):
+        """Read from the socket, waiting for the given timeout instead of the socket's, if it's shorter."""
+        socket_timeout = sock.gettimeout()
+        if timeout is None or socket_timeout is None or timeout >= socket_timeout:
+            return sock.recv(16 * 1024)
 
-        return response
+        sock.settimeout(timeout)
+        try:
+            return sock.recv(16 * 1024)
+        finally:
+            sock.settimeout(socket_timeout)
+
+    def _notify(self, params):
+        """Call the listener callback with a notification's properties, without blocking the reading thread."""
+        callback, executor = self._listener_callback, self._callback_executor
+        if callback is None or executor is None:
+            return
+
+        def run():
+            try:
+                callback(params)
+            except Exception:
+                _LOGGER.exception("%s: The listener callback raised an exception.", self)
+
+        try:
+            executor.submit(run)
+        except RuntimeError:
+            # We stopped listening in the meantime.
+            pass
+
+    def _forget(self, future):
+        """Stop waiting for the response to a command."""
+        with self._write_lock:
+            for command_id, pending in list(self._pending.items()):
+                if pending is future:
+                    del self._pending[command_id]
+            if self._held.get(future.method, (None, None))[1] is future:
+                del self._held[future.method]
+
+        self._send_held(future.method)
+
+    def _resolve(self, response):
+        """Resolve the future of the command a response belongs to."""
+        with self._write_lock:
+            if "id" in response:
+                future = self._pending.pop(response["id"], None)
+            elif self._pending:
+                # Responses without an ID (e.g. invalid ones) can only be for
+                # the oldest command, as the bulb responds in order.
+                future = self._pending.pop(next(iter(self._pending)))
+            else:
+                future = None
+
+        if future is None:
+            _LOGGER.debug("%s: Discarding response to unknown command: %s", self, response)
+            return
+        elif "error" in response:
+            future.set_exception(BulbException(response["error"]))
+        else:
+            future.set_result(response)
+
+        self._send_held(future.method)
+
+    def _discard_socket(self, sock):
+        """Close a socket we no longer use, even if another thread is reading from it."""
+        _shutdown_socket(sock)
+        # Closing a socket while another thread is about to read from it can
+        # leave that thread waiting for the whole timeout, so if someone is
+        # reading, let them close it when they see it was shut down.
+        if self._read_lock.acquire(False):
+            sock.close()
+            self._read_lock.release()
+
+    def _close_socket(self, sock=None):
+        """
+        Close the socket and fail all the commands that are waiting for a response.
+
+        :param socket sock: If given, only close the socket if it's still this
+                            one, and not a newer connection.
+        """
+        with self._write_lock:
+            if sock is not None and sock is not self.__socket:
+                return
+
+            old_socket, self.__socket = self.__socket, None
+            pending, self._pending = self._pending, OrderedDict()
+            held, self._held = self._held, {}
+
+        if old_socket is not None:
+            self._discard_socket(old_socket)
+        for future in list(pending.values()) + [future for _, future in held.values()]:
+            future.set_exception(BulbException("Bulb closed the connection."))
+
+    @contextmanager
+    def batch(self):
+        """
+        Combine several state changes into as few commands as possible.
+
+        Within the ``with`` block, calls to :py:meth:`set_rgb()
+        <yeelight.Bulb.set_rgb()>`, :py:meth:`set_hsv()
+        <yeelight.Bulb.set_hsv()>`, :py:meth:`set_color_temp()
+        <yeelight.Bulb.set_color_temp()>`, :py:meth:`set_brightness()
+        <yeelight.Bulb.set_brightness()>` and :py:meth:`turn_on()
+        <yeelight.Bulb.turn_on()>` are only recorded. When the block exits, the
+        final state is sent to the bulb, usually as a single command (a
+        one-transition flow sets the color and brightness together, and
+        ``set_scene`` also turns the bulb on). With ``auto_on``, the bulb is
+        turned on by the same command, rather than by querying it first.
+
+        Example::
+
+        >>> with bulb.batch():
+        ...     bulb.turn_on()
+        ...     bulb.set_rgb(255, 0, 0)
+        ...     bulb.set_brightness(50)
+
+        Any other command called within the block sends the changes recorded
+        so far before it, so commands are still executed in order. If the block
+        raises an exception, the recorded changes are discarded. Only the
+        commands of the thread that opened the block are recorded; other
+        threads keep sending theirs immediately.
+        """
+        if self._batch is not None:
+            # We're already recording.
+            yield
+            return
+
+        self._batch = batch = _Batch(self)
+        try:
+            yield
+        except BaseException:
+            self._batch = None
+            raise
+
+        self._batch = None
+        batch.flush()
+
+    def apply_state(self, target, **kwargs):
+        """
+        Bring the bulb to a state, sending only the changes it needs.
+
+        The target is compared with the bulb's last known properties (see
+        :py:attr:`last_properties <yeelight.Bulb.last_properties>`), and only
+        the properties that differ are changed, combined into as few commands
+        as possible with :py:meth:`batch() <batch>`. If the bulb is already in
+        the target state, nothing is sent::
+
+            >>> bulb.apply_state({"power": "on", "bright": 50, "ct": 2700})
+            ['power', 'bright', 'ct']
+            >>> bulb.apply_state({"power": "on", "bright": 50, "ct": 2700})
+            []
+
+        Properties the bulb hasn't told us about count as different. If the
+        bulb may have been changed by something else, call
+        :py:meth:`get_properties() <get_properties>` first, or keep the
+        properties current with :py:meth:`start_listening() <start_listening>`.
+
+        :param dict target: The properties to set: ``power`` (``"on"`` or
+                            ``"off"``), ``bright``, and one of ``ct``, ``rgb``
+                            (as an integer), or ``hue`` and ``sat``. An HSV
+                            color and a brightness take two commands, so the
+                            bulb stays in HSV mode.
+        :param kwargs: The ``effect`` and ``duration`` to apply the changes
+                       with.
+
+        :raises ValueError: When the target has only one of ``hue`` and
+                            ``sat``.
+        :returns: The names of the properties that were changed.
+        :rtype: list
+        """
+        if ("hue" in target) != ("sat" in target):
+            raise ValueError("The hue and sat properties must be set together.")
+
+        current = self._last_properties
+
+        def differs(*names):
+            return any(str(current.get(name)) != str(target[name]) for name in names)
+
+        if target.get("power") == "off":
+            if current.get("power") == "off":
+                return []
+            self.turn_off(**kwargs)
+            return ["power"]
+
+        changes = {}
+        if target.get("power") == "on" and current.get("power") != "on":
+            changes["power"] = "on"
+        if "rgb" in target and (current.get("color_mode") != "1" or differs("rgb")):
+            changes.update(rgb=target["rgb"], color_mode="1")
+        elif "ct" in target and (current.get("color_mode") != "2" or differs("ct")):
+            changes.update(ct=target["ct"], color_mode="2")
+        elif "hue" in target and (current.get("color_mode") != "3" or differs("hue", "sat")):
+            changes.update(hue=target["hue"], sat=target["sat"], color_mode="3")
+        if "bright" in target and differs("bright"):
+            changes["bright"] = target["bright"]
+
+        if not changes:
+            return []
+
+        if "hue" in changes:
+            # A batch would send an HSV color with a brightness as an RGB flow,
+            # which leaves the bulb in RGB mode, so send them separately.
+            if "power" in changes:
+                self.turn_on(**kwargs)
+            self.set_hsv(int(changes["hue"]), int(changes["sat"]), **kwargs)
+            if "bright" in changes:
+                self.set_brightness(int(changes["bright"]), **kwargs)
+        else:
+            with self.batch():
+                if "power" in changes:
+                    self.turn_on(**kwargs)
+                if "rgb" in changes:
+                    rgb = int(changes["rgb"])
+                    self.set_rgb(rgb >> 16 & 0xFF, rgb >> 8 & 0xFF, rgb & 0xFF, **kwargs)
+                elif "ct" in changes:
+                    self.set_color_temp(int(changes["ct"]), **kwargs)
+                if "bright" in changes:
+                    self.set_brightness(int(changes["bright"]), **kwargs)
+
+        # Remember the new state, so applying it again sends nothing.
+        self._update_properties({name: str(value) for name, value in changes.items()})
+        return [name for name in ("power", "rgb", "ct", "hue", "sat", "bright") if name in changes]
 
     @_command
     def set_color_temp(self, degrees, **kwargs):
@@ -417,8 +1425,6 @@ class Bulb(object):
         :param int degrees: The degrees to set the color temperature to
                             (1700-6500).
         """
-        self.ensure_on()
-
         degrees = _clamp(degrees, 1700, 6500)
         return "set_ct_abx", [degrees]
 
@@ -431,12 +1437,7 @@ class Bulb(object):
         :param int green: The green value to set (0-255).
         :param int blue: The blue value to set (0-255).
         """
-        self.ensure_on()
-
-        red = _clamp(red, 0, 255)
-        green = _clamp(green, 0, 255)
-        blue = _clamp(blue, 0, 255)
-        return "set_rgb", [red * 65536 + green * 256 + blue]
+        return "set_rgb", [rgb_to_int(red, green, blue)]
 
     @_command
     def set_adjust(self, action, prop, **kwargs):
@@ -467,8 +1468,6 @@ class Bulb(object):
                                brightness will remain the same as before the
                                change.
         """
-        self.ensure_on()
-
         # We fake this using flow so we can add the `value` parameter.
         hue = _clamp(hue, 0, 359)
         saturation = _clamp(saturation, 0, 100)
@@ -485,10 +1484,7 @@ class Bulb(object):
             else:
                 duration = kwargs.get("duration", self.duration)
 
-            hue = _clamp(hue, 0, 359) / 359.0
-            saturation = _clamp(saturation, 0, 100) / 100.0
-            red, green, blue = [int(round(col * 255)) for col in colorsys.hsv_to_rgb(hue, saturation, 1)]
-            rgb = red * 65536 + green * 256 + blue
+            rgb = hsv_to_rgb(hue, saturation)
             return "start_cf", [1, 1, "%s, 1, %s, %s" % (duration, rgb, value)]
 
     @_command
@@ -498,8 +1494,6 @@ class Bulb(object):
 
         :param int brightness: The brightness value to set (1-100).
         """
-        self.ensure_on()
-
         brightness = _clamp(brightness, 1, 100)
         return "set_bright", [brightness]
 
@@ -542,16 +1536,47 @@ class Bulb(object):
         if not isinstance(flow, Flow):
             raise ValueError("Argument is not a Flow instance.")
 
-        self.ensure_on()
+        return "start_cf", flow.params
+
+    def run_flow(self, flow):
+        """
+        Start a flow of any length.
+
+        The bulbs only accept flows of up to nine transitions, so
+        :py:meth:`start_flow() <start_flow>` can't start longer ones. This
+        method splits longer flows into segments the bulb accepts, and starts
+        each segment, in the background, when the one before it ends. Flows
+        that fit are started directly.
+
+        Each segment is a command, so keep the bulb's rate limit in mind when
+        using lots of short transitions.
 
-        return ("start_cf", [flow.count * len(flow.transitions), flow.action.value, flow.expression])
+        Starting another flow with ``run_flow()``, or calling
+        :py:meth:`stop_flow() <stop_flow>`, cancels the remaining segments.
+
+        :param yeelight.Flow flow: The Flow instance to start.
+
+        :returns: The runner that starts the segments.
+        :rtype: yeelight.flow.FlowRunner
+        """
+        if not isinstance(flow, Flow):
+            raise ValueError("Argument is not a Flow instance.")
+
+        if self._flow_runner is not None:
+            self._flow_runner.cancel()
+        self._flow_runner = FlowRunner(self, flow)
+        self._flow_runner.start()
+        return self._flow_runner
 
     @_command
     def stop_flow(self):
-        """Stop a flow."""
+        """Stop a flow, including one started with :py:meth:`run_flow() <run_flow>`."""
+        if self._flow_runner is not None:
+            self._flow_runner.cancel()
+            self._flow_runner = None
         return "stop_cf", []
 
-    def start_music(self, port=0):
+    def start_music(self, port=0, timeout=5):
         """
         Start music mode.
 
@@ -560,37 +1585,215 @@ class Bulb(object):
         to send commands without being rate-limited.
 
         Starting music mode will start a new listening socket, tell the bulb to
-        connect to that, and then close the old connection. If the bulb cannot
-        connect to the host machine for any reason, bad things will happen (such
-        as library freezes).
+        connect to that, and then close the old connection. If the bulb doesn't
+        connect back within ``timeout`` seconds, music mode is cancelled and the
+        old connection keeps being used.
+
+        This blocks until the bulb connects. To negotiate music mode in the
+        background, use :py:meth:`begin_music() <begin_music>`.
+
+        :param int port: The port to listen on. If none is specified, a random
+                         port will be chosen.
+        :param float timeout: How many seconds to wait for the bulb to connect.
+
+        :raises BulbException: When the bulb did not connect back in time.
+        """
+        return self.begin_music(port, timeout).result()
+
+    def begin_music(self, port=0, timeout=5):
+        """
+        Start music mode in the background.
+
+        This works like :py:meth:`start_music() <start_music>`, but returns
+        immediately, with a future that completes when the bulb has connected
+        (or failed to). Cancelling the future before then stops the handshake::
+
+            >>> future = bulb.begin_music(timeout=2)
+            >>> future.cancel()
+
+        When the handshake fails or is cancelled, the listening socket is
+        closed, the bulb is told to leave music mode in case it's still trying
+        to connect, and the old connection keeps being used.
 
         :param int port: The port to listen on. If none is specified, a random
                          port will be chosen.
+        :param float timeout: How many seconds to wait for the bulb to connect.
+
+        :returns: A future whose result is ``"ok"`` once music mode is active.
+        :rtype: concurrent.futures.Future
         """
         if self._music_mode:
             raise AssertionError("Already in music mode, please stop music mode first.")
 
-        # Force populating the cache in case we are being called directly
-        # without ever fetching properties beforehand
-        self.get_properties()
-
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Reuse sockets so we don't hit "address already in use" errors.
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(("", port))
-        host, port = s.getsockname()
         s.listen(3)
 
-        local_ip = self._socket.getsockname()[0]
-        self.send_command("set_music", [1, local_ip, port])
-        s.settimeout(5)
-        conn, _ = s.accept()
-        s.close()  # Close the listening socket.
-        self.__socket.close()
-        self.__socket = conn
-        self._music_mode = True
+        future = Future()
+        thread = threading.Thread(target=self._music_handshake, args=(s, timeout, future), name="yeelight-music")
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def _music_handshake(self, s, timeout, future):
+        """
+        Tell the bulb to connect to the listening socket, and wait for it.
+
+        :param socket s: The listening socket.
+        :param float timeout: How many seconds to wait for the bulb to connect.
+        :param concurrent.futures.Future future: The future to complete.
+        """
+        deadline = time.monotonic() + timeout
+        conn = None
+        try:
+            # Force populating the cache in case we are being called directly
+            # without ever fetching properties beforehand
+            self.get_properties()
+
+            local_ip = self._socket.getsockname()[0]
+            self.send_command("set_music", [1, local_ip, s.getsockname()[1]])
+
+            # Wait in short slices, so we notice when we're cancelled.
+            while not future.cancelled() and time.monotonic() < deadline:
+                readable, _, _ = select.select([s], [], [], max(0, min(0.1, deadline - time.monotonic())))
+                if readable:
+                    conn, _ = s.accept()
+                    break
+        except Exception as ex:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ex)
+            return
+        finally:
+            s.close()  # Close the listening socket.
+
+        if conn is not None and future.set_running_or_notify_cancel():
+            self._enter_music_mode(conn)
+            future.set_result("ok")
+            return
+
+        if conn is not None:
+            conn.close()
+
+        # The bulb didn't connect in time, or we were cancelled, so make sure
+        # it doesn't try to later, and keep using the old connection.
+        try:
+            self.send_command("set_music", [0])
+        except BulbException:
+            _LOGGER.debug("%s: Could not cancel music mode.", self)
+
+        if future.set_running_or_notify_cancel():
+            future.set_exception(BulbException("The bulb did not connect back for music mode."))
+
+    def _enter_music_mode(self, conn):
+        """
+        Switch to the reverse connection the bulb made to us for music mode.
+
+        :param socket conn: The connection the bulb made.
+        """
+        conn.settimeout(5)
+        with self._write_lock:
+            old_socket, self.__socket = self.__socket, conn
+            self._decoder = _LineDecoder()
+            self._music_mode = True
+            pending, self._pending = self._pending, OrderedDict()
+
+        if old_socket is not None:
+            self._discard_socket(old_socket)
+        for future in pending.values():
+            future.set_exception(BulbException("Bulb closed the connection."))
+
+    def stream(self, frames, fps=30, effect="sudden"):
+        """
+        Stream color frames to the bulb at a steady rate, in music mode.
+
+        Each frame is either a packed RGB integer (like the ones the
+        :py:mod:`yeelight.color` converters return, so their output can be
+        streamed directly), a ``(red, green, blue)`` tuple, or a ``(red, green,
+        blue, brightness)`` tuple. Frames are written
+        to the bulb as close to their scheduled time as possible (one every
+        ``1 / fps`` seconds from the start of the stream). If a frame is
+        produced later than the slot after its own, it's dropped rather than
+        sent late, so the stream never falls behind.
 
-        return "ok"
+        Example::
+
+        >>> bulb.start_music()
+        >>> stats = bulb.stream(((255, 0, 0), (0, 255, 0), (0, 0, 255)) * 10, fps=10)
+        >>> stats.fps, stats.jitter
+        (10.0, 0.0004)
+
+        :param iterable frames: The frames to stream. Can be a generator.
+        :param float fps: The number of frames to send per second.
+        :param str effect: The type of effect. Can be "smooth", to fade from
+                           each frame to the next, or "sudden".
+
+        :raises AssertionError: When music mode is not active.
+        :raises BulbException: When a frame could not be sent.
+        :returns: Statistics about the frames that were sent.
+        :rtype: yeelight.StreamStats
+        """
+        if not self._music_mode:
+            raise AssertionError("Music mode is not active, please start music mode first.")
+
+        interval = 1.0 / fps
+        duration = max(30, int(interval * 1000))
+        # Format the messages directly, rather than going through ``json.dumps``
+        # for every frame.
+        rgb_line = '{"id": %%d, "method": "set_rgb", "params": [%%d, "%s", %d]}\r\n' % (effect, duration)
+        bright_line = '{"id": %%d, "method": "set_bright", "params": [%%d, "%s", %d]}\r\n' % (effect, duration)
+
+        sent = dropped = 0
+        lateness = []
+        rgb = brightness = None
+        start = time.monotonic()
+        for index, frame in enumerate(frames):
+            due = start + index * interval
+            now = time.monotonic()
+            if now > due + interval:
+                dropped += 1
+                continue
+            elif now < due:
+                time.sleep(due - now)
+
+            if isinstance(frame, numbers.Integral):
+                rgb, frame_brightness = int(frame), None
+            else:
+                red, green, blue = [_clamp(int(value), 0, 255) for value in frame[:3]]
+                rgb = red * 65536 + green * 256 + blue
+                frame_brightness = _clamp(int(frame[3]), 1, 100) if len(frame) > 3 else None
+
+            with self._write_lock:
+                data = rgb_line % (self._cmd_id, rgb)
+                if frame_brightness is not None and frame_brightness != brightness:
+                    data += bright_line % (self._cmd_id, frame_brightness)
+                    brightness = frame_brightness
+
+                try:
+                    self._socket.sendall(data.encode("utf8"))
+                except socket.error as ex:
+                    self._close_socket()
+                    raise BulbException("A socket error occurred when sending the frame.") from ex
+
+            sent_at = time.monotonic()
+            if not sent:
+                first_sent_at = sent_at
+            lateness.append(sent_at - due)
+            sent += 1
+
+        # Keep the music mode cache up to date.
+        if rgb is not None:
+            self._last_properties["rgb"] = rgb
+        if brightness is not None:
+            self._last_properties["bright"] = brightness
+
+        if sent < 2:
+            return StreamStats(sent, dropped, 0, 0)
+
+        mean = sum(lateness) / sent
+        jitter = (sum((late - mean) ** 2 for late in lateness) / sent) ** 0.5
+        return StreamStats(sent, dropped, (sent - 1) / (sent_at - first_sent_at), jitter)
 
     @_command
     def stop_music(self):
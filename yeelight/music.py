@@ -0,0 +1,141 @@
+"""Music mode for many bulbs at once."""
+
+import logging
+import select
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .main import BulbException
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class MusicHub(object):
+    def __init__(self, port=0, host=""):
+        """
+        A single listening socket that many bulbs can connect to for music mode.
+
+        :py:meth:`Bulb.start_music() <yeelight.Bulb.start_music()>` opens a new
+        listening socket on a random port for every bulb, and waits for each
+        bulb to connect back in turn. The hub listens once, on a fixed port
+        (which makes firewall rules easy), tells many bulbs to connect to it at
+        the same time, and hands each bulb the connection that came from its
+        address::
+
+            >>> hub = MusicHub(port=54321)
+            >>> hub.start_music(bulbs)
+            {<Bulb ...>: None, <Bulb ...>: None}
+
+        :param int port: The port to listen on. If none is specified, a random
+                         port will be chosen.
+        :param str host: The address to listen on. By default, all interfaces.
+        """
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Reuse sockets so we don't hit "address already in use" errors.
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+
+        self._lock = threading.Lock()  # Only one start_music() can accept connections at a time.
+
+    def start_music(self, bulbs, timeout=5, max_workers=32):
+        """
+        Start music mode on many bulbs at once.
+
+        :param list bulbs: The :py:class:`Bulb <yeelight.Bulb>` instances to
+                           start music mode on.
+        :param int timeout: How many seconds to wait for all the bulbs to
+                            connect to the hub.
+        :param int max_workers: How many bulbs to send the ``set_music``
+                                command to at the same time.
+
+        :returns: A dictionary of bulb: error items, where the error is None if
+                  music mode was started successfully, or the exception that
+                  prevented it otherwise.
+        :rtype: dict
+        """
+        results = {}
+        expected = {}  # Peer IP: bulbs we're waiting for a connection from.
+        expected_lock = threading.Lock()
+        deadline = time.monotonic() + timeout
+
+        def request(bulb):
+            # Populate the music mode cache, and find out the addresses the bulb
+            # and us have on the network between us.
+            bulb.get_properties()
+            peer_ip = bulb._socket.getpeername()[0]
+            local_ip = bulb._socket.getsockname()[0]
+            with expected_lock:
+                expected.setdefault(peer_ip, []).append(bulb)
+            bulb.send_command("set_music", [1, local_ip, self.port])
+
+        with self._lock:
+            # Connections that came after the last call's deadline belong to
+            # bulbs that were told to cancel music mode, so they mustn't be
+            # handed to the bulbs of this call.
+            self._drain()
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(bulbs)))) as executor:
+                futures = {}
+                for bulb in bulbs:
+                    if bulb.music_mode:
+                        results[bulb] = AssertionError("Already in music mode, please stop music mode first.")
+                    else:
+                        futures[bulb] = executor.submit(request, bulb)
+
+                waiting = set(futures)
+                while waiting and time.monotonic() < deadline:
+                    # Forget about the bulbs we couldn't send the command to.
+                    for bulb in list(waiting):
+                        if futures[bulb].done() and futures[bulb].exception() is not None:
+                            results[bulb] = futures[bulb].exception()
+                            waiting.discard(bulb)
+
+                    readable, _, _ = select.select(
+                        [self._socket], [], [], max(0, min(0.1, deadline - time.monotonic()))
+                    )
+                    if not readable:
+                        continue
+
+                    conn, (peer_ip, _) = self._socket.accept()
+                    with expected_lock:
+                        candidates = [bulb for bulb in expected.get(peer_ip, []) if bulb in waiting]
+                    if not candidates:
+                        _LOGGER.debug("Closing unexpected music mode connection from %s.", peer_ip)
+                        conn.close()
+                        continue
+
+                    bulb = candidates[0]
+                    bulb._enter_music_mode(conn)
+                    results[bulb] = None
+                    waiting.discard(bulb)
+
+            for bulb in waiting:
+                if futures[bulb].exception() is not None:
+                    results[bulb] = futures[bulb].exception()
+                    continue
+
+                # Like Bulb.start_music(), make sure the bulb doesn't try to
+                # connect later, and keep using the old connection.
+                try:
+                    bulb.send_command("set_music", [0])
+                except BulbException:
+                    _LOGGER.debug("%s: Could not cancel music mode.", bulb)
+                results[bulb] = BulbException("The bulb did not connect back for music mode.")
+
+            self._drain()
+
+        return results
+
+    def _drain(self):
+        """Close the connections waiting to be accepted."""
+        while select.select([self._socket], [], [], 0)[0]:
+            conn, (peer_ip, _) = self._socket.accept()
+            _LOGGER.debug("Closing stale music mode connection from %s.", peer_ip)
+            conn.close()
+
+    def close(self):
+        """Stop listening for connections."""
+        self._socket.close()
@@ -0,0 +1,365 @@
+"""A single-threaded reactor for controlling many bulbs at once."""
+
+import errno
+import heapq
+import itertools
+import json
+import logging
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from .main import _AUTO_ON_METHODS, _DEFAULT_PROPERTIES, BulbException, _build_command
+from .utils import _LineDecoder
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class _Connection(object):
+    """The reactor's non-blocking connection to a single bulb."""
+
+    def __init__(self, bulb):
+        self.bulb = bulb
+        self.sock = None
+        self.connected = False
+        self.outgoing = bytearray()  # Data waiting to be written.
+        self.decoder = _LineDecoder()
+        self.pending = OrderedDict()  # Command ID: (future, transform).
+
+
+class BulbReactor(object):
+    def __init__(self, timeout=5):
+        """
+        A reactor that drives the connections to many bulbs from a single thread.
+
+        Instead of each :py:class:`Bulb <yeelight.Bulb>` blocking on its own
+        socket, the reactor owns a non-blocking connection to each bulb, and
+        waits for all of them at once with a selector. Commands are submitted
+        from any thread and return futures, so commands to many bulbs (or many
+        commands to one bulb) can be in flight at the same time::
+
+            >>> reactor = BulbReactor()
+            >>> reactor.start()
+            >>> futures = [reactor.submit(bulb, "set_rgb", 255, 0, 0) for bulb in bulbs]
+            >>> [future.result() for future in futures]
+
+        The reactor uses its own connections, separate from the ones the bulbs'
+        blocking methods use, and doesn't support music mode.
+
+        :param int timeout: How many seconds to wait for a response to each
+                            command (or for the connection to be established)
+                            before failing it and closing the connection.
+        """
+        self.timeout = timeout
+
+        self._selector = selectors.DefaultSelector()
+        self._connections = {}  # Bulb: _Connection.
+        self._submissions = deque()  # Commands submitted from other threads.
+        self._deadlines = []  # A heap of (deadline, sequence number, command ID, connection).
+        self._sequence = itertools.count()  # Breaks ties between deadlines.
+        self._running = False
+        self._closed = False  # Whether the loop has exited and released its resources.
+        self._thread = None
+
+        # A socket pair to wake the selector up when commands are submitted.
+        self._waker, self._wakee = socket.socketpair()
+        self._waker.setblocking(False)
+        self._wakee.setblocking(False)
+        self._selector.register(self._wakee, selectors.EVENT_READ)
+
+    def submit(self, bulb, method, *args, **kwargs):
+        """
+        Call one of a bulb's command methods through the reactor.
+
+        The command is built exactly like the bulb's own method builds it,
+        including the bulb's default effect, duration and power mode. If the
+        bulb has ``auto_on`` set, a ``turn_on`` is pipelined before the command
+        instead of querying the bulb's power state first, unless the bulb is
+        known to be on (see :py:attr:`Bulb.power_ttl
+        <yeelight.Bulb.power_ttl>`).
+
+        :param yeelight.Bulb bulb: The bulb to send the command to.
+        :param str method: The name of the bulb method to call, e.g. ``"set_rgb"``.
+        :param args: The arguments to pass to the method.
+        :param kwargs: The keyword arguments to pass to the method.
+
+        :returns: A future with the method's result.
+        :rtype: concurrent.futures.Future
+        """
+        command, params = _build_command(getattr(type(bulb), method).__wrapped__, bulb, *args, **kwargs)
+        if command in _AUTO_ON_METHODS and bulb.auto_on and not bulb.music_mode and not _is_on(bulb):
+            self.submit(bulb, "turn_on")
+
+        sent = time.monotonic()
+
+        def transform(response):
+            bulb._track_power(command, params, sent)
+            return _first_result(response)
+
+        return self._submit(bulb, command, params, transform)
+
+    def send_command(self, bulb, method, params=None):
+        """
+        Send a raw command to a bulb through the reactor.
+
+        :param yeelight.Bulb bulb: The bulb to send the command to.
+        :param str method:  The name of the method to send.
+        :param list params: The list of parameters for the method.
+
+        :returns: A future with the response from the bulb.
+        :rtype: concurrent.futures.Future
+        """
+        return self._submit(bulb, method, params, None)
+
+    def get_properties(self, bulb, requested_properties=_DEFAULT_PROPERTIES):
+        """
+        Retrieve the properties of a bulb through the reactor.
+
+        This also updates the bulb's ``last_properties``, just like
+        :py:meth:`Bulb.get_properties() <yeelight.Bulb.get_properties()>` does.
+
+        :param yeelight.Bulb bulb: The bulb to retrieve the properties of.
+        :param list requested_properties: The list of properties to request from the bulb.
+
+        :returns: A future with a dictionary of param: value items.
+        :rtype: concurrent.futures.Future
+        """
+        return self._submit(
+            bulb,
+            "get_prop",
+            requested_properties,
+            lambda response: bulb._store_properties(requested_properties, response),
+        )
+
+    def start(self):
+        """Start running the reactor in a background thread."""
+        self._check_not_closed()
+        if self._thread is not None:
+            return
+
+        # Set before the thread starts, so that a stop() before the thread
+        # gets going isn't undone.
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="yeelight-reactor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the reactor, close all the connections and fail any outstanding commands.
+
+        A stopped reactor can't be started again, and fails the commands
+        submitted to it.
+        """
+        self._running = False
+        self._wake()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def run(self):
+        """Run the reactor in the current thread, until :py:meth:`stop() <stop>` is called."""
+        self._check_not_closed()
+        self._running = True
+        self._loop()
+
+    def _loop(self):
+        """Handle the connections until the reactor is stopped."""
+        try:
+            while self._running:
+                self._process_submissions()
+                self._process_timeouts()
+
+                timeout = None
+                if self._deadlines:
+                    timeout = max(0, self._deadlines[0][0] - time.monotonic())
+
+                for key, mask in self._selector.select(timeout):
+                    if key.fileobj is self._wakee:
+                        self._drain_waker()
+                        continue
+
+                    connection = key.data
+                    if mask & selectors.EVENT_WRITE:
+                        self._handle_write(connection)
+                    if mask & selectors.EVENT_READ and connection.sock is not None:
+                        self._handle_read(connection)
+        finally:
+            for connection in list(self._connections.values()):
+                self._close(connection, "The reactor was stopped.")
+            # Commands submitted from now on fail right away, so fail the ones
+            # that were submitted before.
+            self._running = False
+            self._closed = True
+            self._process_submissions()
+
+            self._selector.close()
+            self._waker.close()
+            self._wakee.close()
+
+    def _check_not_closed(self):
+        """Raise an exception if the reactor was stopped."""
+        if self._closed:
+            raise BulbException("The reactor was stopped.")
+
+    def _submit(self, bulb, method, params, transform):
+        """Queue a command for the reactor thread to send and return its future."""
+        bulb._check_supported(method)
+        future = Future()
+        self._submissions.append((bulb, method, params, transform, future))
+        if self._closed:
+            # There's no reactor thread to process the command anymore.
+            self._process_submissions()
+        else:
+            self._wake()
+        return future
+
+    def _wake(self):
+        """Wake the reactor thread up."""
+        try:
+            self._waker.send(b"\0")
+        except socket.error:
+            # The buffer is full, so the reactor will wake up anyway.
+            pass
+
+    def _drain_waker(self):
+        """Discard the wake-up data."""
+        try:
+            while self._wakee.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _process_submissions(self):
+        """Write the commands that were submitted since we last checked."""
+        while self._submissions:
+            bulb, method, params, transform, future = self._submissions.popleft()
+            if not self._running:
+                future.set_exception(BulbException("The reactor is not running."))
+                continue
+
+            connection = self._connections.get(bulb)
+            if connection is None:
+                connection = self._connect(bulb)
+                if connection is None:
+                    future.set_exception(BulbException("A socket error occurred when connecting to the bulb."))
+                    continue
+
+            command = {"id": bulb._cmd_id, "method": method, "params": params}
+            _LOGGER.debug("%s > %s", bulb, command)
+
+            connection.outgoing += (json.dumps(command) + "\r\n").encode("utf8")
+            connection.pending[command["id"]] = (future, transform)
+            heapq.heappush(
+                self._deadlines, (time.monotonic() + self.timeout, next(self._sequence), command["id"], connection)
+            )
+            if connection.connected:
+                self._selector.modify(connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+
+    def _process_timeouts(self):
+        """Fail the commands the bulbs haven't responded to in time."""
+        now = time.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, command_id, connection = heapq.heappop(self._deadlines)
+            if command_id in connection.pending:
+                # Like the blocking bulb, give up on the connection.
+                self._close(connection, "The bulb did not respond to the command.")
+
+    def _connect(self, bulb):
+        """Start connecting to a bulb."""
+        connection = _Connection(bulb)
+        connection.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connection.sock.setblocking(False)
+        error = connection.sock.connect_ex((bulb._ip, bulb._port))
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            connection.sock.close()
+            return None
+
+        self._selector.register(connection.sock, selectors.EVENT_WRITE, connection)
+        self._connections[bulb] = connection
+        return connection
+
+    def _close(self, connection, reason):
+        """Close a connection and fail its outstanding commands."""
+        if connection.sock is not None:
+            self._selector.unregister(connection.sock)
+            connection.sock.close()
+            connection.sock = None
+        self._connections.pop(connection.bulb, None)
+
+        pending, connection.pending = connection.pending, OrderedDict()
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(BulbException(reason))
+
+    def _handle_write(self, connection):
+        """Finish connecting, or write as much of the outgoing data as we can."""
+        if not connection.connected:
+            error = connection.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self._close(connection, "A socket error occurred when connecting to the bulb.")
+                return
+            connection.connected = True
+
+        try:
+            sent = connection.sock.send(connection.outgoing)
+        except socket.error:
+            self._close(connection, "A socket error occurred when sending the command.")
+            return
+        del connection.outgoing[:sent]
+
+        events = selectors.EVENT_READ
+        if connection.outgoing:
+            events |= selectors.EVENT_WRITE
+        self._selector.modify(connection.sock, events, connection)
+
+    def _handle_read(self, connection):
+        """Read from a bulb, and handle the responses and notifications received."""
+        try:
+            data = connection.sock.recv(16 * 1024)
+        except socket.error:
+            data = b""
+
+        if not data:
+            self._close(connection, "Bulb closed the connection.")
+            return
+
+        bulb = connection.bulb
+        for line in connection.decoder.feed(data):
+            _LOGGER.debug("%s < %s", bulb, line)
+
+            if line.get("method") == "props":
+                bulb._update_properties(line["params"])
+                continue
+
+            if "id" in line:
+                future, transform = connection.pending.pop(line["id"], (None, None))
+            elif connection.pending:
+                future, transform = connection.pending.popitem(last=False)[1]
+            else:
+                future = None
+
+            if future is None or future.done():
+                _LOGGER.debug("%s: Discarding response to unknown command: %s", bulb, line)
+            elif "error" in line:
+                future.set_exception(BulbException(line["error"]))
+            else:
+                try:
+                    future.set_result(transform(line) if transform else line)
+                except Exception as ex:
+                    future.set_exception(ex)
+
+
+def _is_on(bulb):
+    """Return whether the bulb is known to be on."""
+    return bulb.last_properties.get("power") == "on" and bulb._is_fresh("power", bulb.power_ttl)
+
+
+def _first_result(response):
+    """Return the first result of a response, like the bulb's command methods do."""
+    result = response.get("result", [])
+    if result:
+        return result[0]
@@ -0,0 +1,197 @@
+"""Compute what a flow shows, without a bulb."""
+
+from bisect import bisect_right
+
+from .color import kelvin_to_rgb, numpy
+from .flow import Action
+
+# What a simulated bulb shows before a flow, if nothing else is specified.
+_DEFAULT_START = (0xFFFFFF, 100)
+
+
+class FlowSimulator(object):
+    def __init__(self, flow, start=None):
+        """
+        Compute the color and brightness a bulb shows while running a flow.
+
+        Each transition fades the color and brightness linearly from the state
+        the transition before it ended at, color temperatures are shown as
+        their RGB equivalent, and sleep transitions keep the previous state.
+        The flow is repeated ``count`` times (or forever), and its action is
+        applied when it ends, with a bulb that's off having a brightness of
+        zero::
+
+            >>> simulator = FlowSimulator(Flow(1, Flow.actions.off, [RGBTransition(255, 0, 0, duration=1000)]),
+            ...                           start=(0x0000FF, 100))
+            >>> simulator.state(500)
+            (8388736, 100)
+            >>> simulator.sample([0, 500, 1000, 2000])
+            (array([     255,  8388736, 16711680, 16711680]), array([100, 100,   0,   0]))
+
+        Times are in milliseconds since the flow started, like transition
+        durations. The simulation is based on the flow as it is when the
+        simulator is created.
+
+        :param yeelight.Flow flow: The flow to simulate.
+        :param tuple start: The (packed RGB, brightness) state of the bulb
+                            before the flow starts. By default, the flow
+                            starts from the state it ends each run at, as if
+                            it had already been running.
+        """
+        self.flow = flow
+        self.count = flow.count
+        self.action = flow.action
+
+        steps = [transition.as_list() for transition in flow.transitions]
+        self._durations = [max(50, step[0]) for step in steps]
+        self._ends = []
+        end = 0
+        for duration in self._durations:
+            end += duration
+            self._ends.append(end)
+
+        # How long a run of the flow takes, in milliseconds.
+        self.period = end
+
+        # The state at the start of every transition, for the first run of the
+        # flow and for the runs after it, and the state every transition ends
+        # at, which is the same for every run.
+        loop_start = self._run(steps, start or _DEFAULT_START)[-1]
+        self.start = start or loop_start
+        self._first = self._run(steps, self.start)
+        self._loop = self._run(steps, loop_start)
+
+    @staticmethod
+    def _run(steps, start):
+        """Return the states a run of the flow goes through, from ``start`` to its end."""
+        states = [(start[0], start[1])]
+        for _, mode, value, brightness in steps:
+            rgb, previous_brightness = states[-1]
+            if mode == 1:
+                rgb = value
+            elif mode == 2:
+                rgb = kelvin_to_rgb(value)
+            if mode == 7 or brightness < 0:
+                brightness = previous_brightness
+            states.append((rgb, brightness))
+        return states
+
+    @property
+    def duration(self):
+        """How long the flow runs for, in milliseconds, or None if it runs forever."""
+        if not self.count or not self._ends:
+            return None
+        return self.count * self.period
+
+    @property
+    def final(self):
+        """The (packed RGB, brightness) state the bulb is left at when the flow ends."""
+        if self.action is Action.recover:
+            return self.start
+        rgb, brightness = (self._first if self.count == 1 else self._loop)[-1]
+        if self.action is Action.off:
+            return rgb, 0
+        return rgb, brightness
+
+    def state(self, time):
+        """
+        Compute the state of the bulb at a point in the flow.
+
+        :param float time: The number of milliseconds since the flow started.
+
+        :returns: The packed RGB value and brightness of the bulb.
+        :rtype: tuple
+        """
+        if time < 0 or not self._ends:
+            return self.start
+        if self.count and time >= self.count * self.period:
+            return self.final
+
+        run = int(time // self.period)
+        offset = time - run * self.period
+        index = min(bisect_right(self._ends, offset), len(self._ends) - 1)
+        fraction = (offset - (self._ends[index] - self._durations[index])) / self._durations[index]
+
+        states = self._first if run == 0 else self._loop
+        (from_rgb, from_brightness), (to_rgb, to_brightness) = states[index], states[index + 1]
+        rgb = [
+            int(round(start + (end - start) * fraction)) for start, end in zip(_channels(from_rgb), _channels(to_rgb))
+        ]
+        brightness = int(round(from_brightness + (to_brightness - from_brightness) * fraction))
+        return rgb[0] * 65536 + rgb[1] * 256 + rgb[2], brightness
+
+    def sample(self, times):
+        """
+        Compute the state of the bulb at many points in the flow at once.
+
+        With NumPy installed, all the points are computed together, which is
+        much faster than calling :py:meth:`state` for each of them, and gives
+        the same results.
+
+        :param list times: The numbers of milliseconds since the flow started.
+
+        :returns: The packed RGB values and the brightnesses at those times, as
+                  NumPy arrays if NumPy is installed, or lists otherwise.
+        :rtype: tuple
+        """
+        if numpy is None or not self._ends:
+            states = [self.state(time) for time in times]
+            return [rgb for rgb, _ in states], [brightness for _, brightness in states]
+
+        times = numpy.asarray(times, dtype=float)
+        ends = numpy.array(self._ends, dtype=float)
+        durations = numpy.array(self._durations, dtype=float)
+
+        run = numpy.floor_divide(times, self.period)
+        offset = times - run * self.period
+        index = numpy.minimum(numpy.searchsorted(ends, offset, side="right"), len(ends) - 1)
+        fraction = (offset - (ends[index] - durations[index])) / durations[index]
+
+        # Every state as red, green, blue and brightness columns.
+        first = numpy.array([_channels(rgb) + (brightness,) for rgb, brightness in self._first], dtype=float)
+        loop = numpy.array([_channels(rgb) + (brightness,) for rgb, brightness in self._loop], dtype=float)
+        states = numpy.where((run == 0)[:, None], first[index], loop[index])
+        targets = numpy.where((run == 0)[:, None], first[index + 1], loop[index + 1])
+        values = numpy.rint(states + (targets - states) * fraction[:, None]).astype(int)
+
+        rgb = values[:, 0] * 65536 + values[:, 1] * 256 + values[:, 2]
+        brightness = values[:, 3]
+
+        # Before and after the flow runs.
+        before = times < 0
+        rgb[before], brightness[before] = self.start
+        if self.count:
+            after = times >= self.count * self.period
+            rgb[after], brightness[after] = self.final
+        return rgb, brightness
+
+    def timeline(self, fps=30, duration=None):
+        """
+        Sample the flow at a steady rate, for example to render a preview.
+
+        :param float fps: The number of samples per second.
+        :param float duration: How many milliseconds to sample. By default, the
+                               whole flow, or a single run of it if it runs
+                               forever.
+
+        :returns: The times of the samples, and the packed RGB values and
+                  brightnesses at those times, as NumPy arrays if NumPy is
+                  installed, or lists otherwise.
+        :rtype: tuple
+        """
+        if duration is None:
+            duration = self.duration if self.duration is not None else self.period
+
+        interval = 1000.0 / fps
+        samples = int(duration / interval) + 1
+        if numpy is not None:
+            times = numpy.arange(samples) * interval
+        else:
+            times = [sample * interval for sample in range(samples)]
+        rgb, brightness = self.sample(times)
+        return times, rgb, brightness
+
+
+def _channels(rgb):
+    """Split a packed RGB value into its red, green and blue components."""
+    return rgb >> 16 & 0xFF, rgb >> 8 & 0xFF, rgb & 0xFF
@@ -1,23 +1,61 @@
+import asyncio
+import colorsys
+import contextlib
 import json
 import os
+import socket
+import struct
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from itertools import islice
 
-from yeelight import Bulb  # noqa
-from yeelight import enums
+from yeelight import Bulb, BulbException, RateLimitException, discover_bulbs, discover_bulbs_iter  # noqa
+from yeelight import Flow, HSVTransition, RGBTransition, SleepTransition, TemperatureTransition, color, enums
+from yeelight import simulator
+from yeelight.aio import AsyncBulb
+from yeelight.discovery import BulbListener, DiscoveryCache, scan_bulbs
+from yeelight.group import BulbGroup
+from yeelight.main import get_ip_address
+from yeelight.music import MusicHub
+from yeelight.reactor import BulbReactor
+from yeelight.simulator import FlowSimulator
+from yeelight.utils import _LineDecoder
 
 sys.path.insert(0, os.path.abspath(__file__ + "/../.."))
 
 
 class SocketMock(object):
-    def __init__(self, received=b'{"id": 0, "result": ["ok"]}'):
+    def __init__(self, received=None):
         self.received = received
+        self.unanswered = []
+        self.sent_all = []
+        self.timeout = 5
+
+    def gettimeout(self):
+        return self.timeout
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
 
     def send(self, data):
         self.sent = json.loads(data.decode("utf8"))
+        self.sent_all.append(self.sent)
+        self.unanswered.append(self.sent["id"])
+
+    def methods(self):
+        return [command["method"] for command in self.sent_all]
 
     def recv(self, length):
-        return self.received
+        if self.received is not None:
+            return self.received
+
+        # Reply "ok" to every command we haven't answered yet.
+        ids, self.unanswered = self.unanswered, []
+        return b"".join(('{"id": %s, "result": ["ok"]}\r\n' % i).encode("utf8") for i in ids)
 
 
 class Tests(unittest.TestCase):
@@ -137,6 +175,1044 @@ class Tests(unittest.TestCase):
         self.assertEqual(self.socket.sent["method"], "set_ct_abx")
         self.assertEqual(self.socket.sent["params"], [6500, "sudden", 300])
 
+    def test_rate_limit(self):
+        bulb = Bulb(ip="", rate_limit=2, rate_limit_wait=False)
+        bulb._Bulb__socket = self.socket
+        self.assertEqual(bulb.rate_limit_remaining, 2)
+        bulb.set_brightness(10)
+        bulb.set_brightness(20)
+        self.assertEqual(bulb.rate_limit_remaining, 0)
+        self.assertRaises(RateLimitException, bulb.set_brightness, 30)
+        self.assertEqual(self.socket.sent["params"], [20, "smooth", 300])
+
+        bulb._music_mode = True
+        bulb.set_brightness(30)
+        self.assertEqual(self.socket.sent["params"], [30, "smooth", 300])
+
+    def test_coalescing(self):
+        self.bulb.coalesce = True
+
+        futures = [self.bulb.submit_command("set_bright", [brightness]) for brightness in (10, 20, 30)]
+        self.assertEqual([command["params"] for command in self.socket.sent_all], [[10]])
+        # A command of another kind sends the held command before it.
+        futures.append(self.bulb.submit_command("set_rgb", [255]))
+        self.assertEqual([command["params"] for command in self.socket.sent_all], [[10], [30], [255]])
+        self.assertEqual([future.result()["result"] for future in futures], [["ok"]] * 4)
+
+        del self.socket.sent_all[:]
+        futures = [
+            self.bulb.submit_command("set_power", ["on"]),
+            self.bulb.submit_command("start_cf", [1, 0, "500, 1, 255, 100"]),
+            self.bulb.submit_command("set_power", ["off"]),
+            self.bulb.submit_command("stop_cf", []),
+        ]
+        [future.result() for future in futures]
+        self.assertEqual(
+            [command["method"] for command in self.socket.sent_all], ["set_power", "start_cf", "set_power", "stop_cf"]
+        )
+
+    def test_batch1(self):
+        with self.bulb.batch():
+            self.bulb.turn_on()
+            self.bulb.set_rgb(255, 0, 0)
+            self.bulb.set_brightness(50, duration=1000)
+        self.assertEqual([command["method"] for command in self.socket.sent_all], ["set_scene"])
+        self.assertEqual(self.socket.sent_all[0]["params"], ["cf", 1, 1, "1000, 1, 16711680, 50"])
+
+    def test_batch2(self):
+        self.bulb.auto_on = False
+        with self.bulb.batch():
+            self.bulb.set_hsv(200, 100, effect="sudden")
+            self.bulb.set_brightness(10)
+        self.assertEqual(self.socket.sent["method"], "start_cf")
+        self.assertEqual(self.socket.sent["params"], [1, 1, "50, 1, 43263, 10"])
+
+    def test_batch3(self):
+        self.bulb.auto_on = False
+        with self.bulb.batch():
+            self.bulb.set_color_temp(2700)
+            self.bulb.set_color_temp(3000)
+        self.assertEqual(self.socket.sent["method"], "set_ct_abx")
+        self.assertEqual(self.socket.sent["params"], [3000, "smooth", 300])
+
+        with self.bulb.batch():
+            self.bulb.set_brightness(10)
+            self.bulb.toggle()
+            self.assertEqual(self.socket.sent["method"], "toggle")
+            self.bulb.set_brightness(20)
+        self.assertEqual(self.socket.sent["params"], [20, "smooth", 300])
+
+    def test_batch_power_mode(self):
+        self.bulb.power_mode = enums.PowerMode.RGB
+        with self.bulb.batch():
+            self.bulb.turn_on()
+        self.assertEqual(self.socket.sent["params"], ["on", "smooth", 300, 2])
+
+    def test_batch_threads(self):
+        self.bulb.auto_on = False
+        with self.bulb.batch():
+            self.bulb.set_brightness(10)
+            # Other threads aren't recorded.
+            thread = threading.Thread(target=self.bulb.set_rgb, args=(255, 0, 0))
+            thread.start()
+            thread.join()
+            self.assertEqual(self.socket.sent["method"], "set_rgb")
+        self.assertEqual(self.socket.sent["params"], [10, "smooth", 300])
+
+    def test_stream(self):
+        self.assertRaises(AssertionError, self.bulb.stream, [0])
+
+        sent = []
+        self.socket.sendall = lambda data: sent.extend(data.decode("utf8").splitlines())
+        self.bulb._music_mode = True
+
+        def frames():
+            yield 0xFF0000
+            yield (0, 255, 0, 50)
+            time.sleep(0.12)  # Too late for the next slot, but not the one after.
+            yield (0, 0, 255, 50)
+            yield (0, 0, 255, 60)
+
+        stats = self.bulb.stream(frames(), fps=20)
+        self.assertEqual((stats.sent, stats.dropped), (3, 1))
+        self.assertEqual(
+            [(command["method"], command["params"]) for command in map(json.loads, sent)],
+            [
+                ("set_rgb", [0xFF0000, "sudden", 50]),
+                ("set_rgb", [0x00FF00, "sudden", 50]),
+                ("set_bright", [50, "sudden", 50]),
+                ("set_rgb", [0x0000FF, "sudden", 50]),
+                ("set_bright", [60, "sudden", 50]),
+            ],
+        )
+        self.assertEqual(self.bulb.last_properties["bright"], 60)
+
+        # The batch color converters' output can be streamed directly.
+        del sent[:]
+        frames = color.hsv_to_rgb([0, 120, 240], 100)
+        self.assertEqual(self.bulb.stream(frames, fps=100).sent, 3)
+        self.assertEqual([json.loads(line)["params"][0] for line in sent], [int(rgb) for rgb in frames])
+        self.assertEqual(self.bulb.last_properties["rgb"], int(frames[-1]))
+
+    def test_apply_state(self):
+        self.bulb.auto_on = False
+        self.bulb._last_properties.update({"power": "off", "bright": "10", "color_mode": "2", "ct": "2700"})
+
+        target = {"power": "on", "bright": 50, "ct": 2700}
+        self.assertEqual(self.bulb.apply_state(target, effect="sudden"), ["power", "bright"])
+        self.assertEqual([command["method"] for command in self.socket.sent_all], ["set_power", "set_bright"])
+
+        del self.socket.sent_all[:]
+        self.assertEqual(self.bulb.apply_state(target), [])
+        self.assertEqual(self.socket.sent_all, [])
+
+        target = {"power": "on", "bright": 20, "rgb": 16711680}
+        self.assertEqual(self.bulb.apply_state(target, duration=1000), ["rgb", "bright"])
+        self.assertEqual([command["method"] for command in self.socket.sent_all], ["start_cf"])
+        self.assertEqual(self.socket.sent_all[0]["params"], [1, 1, "1000, 1, 16711680, 20"])
+
+        # HSV colors are sent as HSV, so the bulb reports the same state back.
+        del self.socket.sent_all[:]
+        target = {"power": "on", "bright": 30, "hue": 200, "sat": 50}
+        self.assertEqual(self.bulb.apply_state(target), ["hue", "sat", "bright"])
+        self.assertEqual([command["method"] for command in self.socket.sent_all], ["set_hsv", "set_bright"])
+        self.assertEqual(self.bulb.last_properties["color_mode"], "3")
+        self.assertEqual(self.bulb.apply_state(target), [])
+        self.assertRaises(ValueError, self.bulb.apply_state, {"hue": 200})
+
+        self.assertEqual(self.bulb.apply_state({"power": "off", "bright": 20}), ["power"])
+        self.assertEqual(self.socket.sent_all[-1]["method"], "set_power")
+        self.assertEqual(self.socket.sent_all[-1]["params"][0], "off")
+
+    def test_power_ttl(self):
+        # Without a TTL, the bulb is queried before every command.
+        self.bulb.set_brightness(10)
+        self.bulb.set_brightness(20)
+        self.assertEqual(self.socket.methods().count("get_prop"), 2)
+
+        del self.socket.sent_all[:]
+        self.bulb.power_ttl = 60
+        self.bulb.turn_off()
+        self.bulb.set_brightness(10)
+        self.bulb.set_brightness(20)
+        # We turned the bulb off, so it's turned back on, but never queried.
+        self.assertEqual(self.socket.methods(), ["set_power", "set_power", "set_bright", "set_bright"])
+
+        # A notification that the bulb was switched off is trusted too.
+        del self.socket.sent_all[:]
+        self.socket.received = (
+            '{"method": "props", "params": {"power": "off"}}\r\n{"id": %s, "result": ["ok"]}\r\n'
+            % self.bulb._Bulb__cmd_id
+        ).encode("utf8")
+        self.bulb.toggle()
+        self.assertEqual(self.bulb.last_properties["power"], "off")
+        self.socket.received = None
+        self.bulb.set_brightness(30)
+        self.assertEqual(self.socket.methods(), ["toggle", "set_power", "set_bright"])
+
+        # Batches keep track of the power state too.
+        del self.socket.sent_all[:]
+        self.bulb.turn_off()
+        with self.bulb.batch():
+            self.bulb.turn_on()
+            self.bulb.set_rgb(255, 0, 0)
+        self.bulb.set_brightness(10)
+        self.assertEqual(self.socket.methods(), ["set_power", "set_scene", "set_bright"])
+
+    def test_max_age(self):
+        self.socket.received = b'{"id": 0, "result": ["on", "10"]}\r\n'
+        properties = self.bulb.get_properties(["power", "bright"], max_age=5)
+        self.assertEqual(properties, {"power": "on", "bright": "10", "current_brightness": "10"})
+
+        # Everything is fresh, so the bulb isn't asked.
+        self.assertEqual(self.bulb.get_properties(["power", "bright"], max_age=5)["bright"], "10")
+        self.assertEqual(len(self.socket.sent_all), 1)
+
+        # Only the properties we don't know are queried.
+        self.socket.received = b'{"id": 1, "result": ["2700"]}\r\n'
+        properties = self.bulb.get_properties(["power", "ct"], max_age=5)
+        self.assertEqual(self.socket.sent_all[-1]["params"], ["ct"])
+        self.assertEqual(properties, {"power": "on", "ct": "2700", "current_brightness": "10"})
+        self.assertEqual(self.bulb.last_properties["bright"], "10")
+
+        # Notifications count as fresh values too.
+        self.socket.received = b'{"method": "props", "params": {"ct": "4000"}}\r\n{"id": 2, "result": ["ok"]}\r\n'
+        self.bulb.send_command("set_ct_abx", [4000])
+        self.assertEqual(self.bulb.get_properties(["ct"], max_age=5)["ct"], "4000")
+        self.assertEqual(len(self.socket.sent_all), 3)
+
+    def test_from_discovery(self):
+        bulb = Bulb.from_discovery(
+            {
+                "ip": "192.168.0.19",
+                "port": 55443,
+                "capabilities": {"id": "0x1", "model": "mono", "support": "get_prop set_power toggle set_bright"},
+            },
+            auto_on=True,
+        )
+        bulb._Bulb__socket = self.socket
+        self.assertEqual(bulb.get_model_specs()["color_temp"], {"min": 2700, "max": 2700})
+        self.assertTrue(bulb.auto_on)
+
+        self.assertRaises(BulbException, bulb.set_rgb, 255, 0, 0)
+        self.assertRaises(BulbException, bulb.send_command, "bg_set_rgb", [255])
+        # The bulb was never asked.
+        self.assertFalse(hasattr(self.socket, "sent"))
+
+        bulb.set_brightness(10)
+        self.assertEqual(self.socket.sent["method"], "set_bright")
+
+    def test_pipelining(self):
+        first = self.bulb.submit_command("set_bright", [10])
+        second = self.bulb.submit_command("get_prop", ["power"])
+        self.socket.received = (
+            b'{"id": %d, "result": ["on"]}\r\n{"method": "props", "params": {"bright": "10"}}\r\n'
+            b'{"id": %d, "error": {"code": -1, "message": "unsupported"}}\r\n'
+        ) % (self.socket.unanswered[1], self.socket.unanswered[0])
+        self.assertEqual(second.result(), {"id": self.socket.unanswered[1], "result": ["on"]})
+        self.assertRaises(BulbException, first.result)
+        self.assertEqual(self.bulb.last_properties["bright"], "10")
+
+    def test_stale_response(self):
+        self.socket.received = b'{"id": 1000, "result": ["late"]}\r\n'
+        future = self.bulb.submit_command("set_bright", [10])
+        self.bulb._read_responses()
+        self.assertFalse(future.done())
+        self.socket.received = None
+        self.assertEqual(future.result()["result"], ["ok"])
+
+
+class FlowTests(unittest.TestCase):
+    def test_compiled(self):
+        transitions = [RGBTransition(255, 0, 0, duration=100), SleepTransition(400)]
+        flow = Flow(2, Flow.actions.stay, transitions)
+        self.assertEqual(flow.expression, "100, 1, 16711680, 100, 400, 7, 1, 2")
+        self.assertEqual(flow.params, [4, 1, "100, 1, 16711680, 100, 400, 7, 1, 2"])
+        self.assertIs(flow.expression, flow.expression)
+
+        # Changing the flow, or any of its transitions, rebuilds it.
+        flow.count = 1
+        flow.action = Flow.actions.off
+        self.assertEqual(flow.params[:2], [2, 2])
+        transitions[0].green = 255
+        self.assertEqual(flow.expression, "100, 1, 16776960, 100, 400, 7, 1, 2")
+        transitions.append(HSVTransition(200, 100, duration=50))
+        self.assertEqual(flow.params, [3, 2, "100, 1, 16776960, 100, 400, 7, 1, 2, 50, 1, 43263, 100"])
+
+    def test_start_flow(self):
+        bulb = Bulb(ip="")
+        bulb._Bulb__socket = SocketMock()
+        bulb.start_flow(Flow(0, Flow.actions.recover, [RGBTransition(0, 0, 255)]))
+        self.assertEqual(bulb._Bulb__socket.sent["method"], "start_cf")
+        self.assertEqual(bulb._Bulb__socket.sent["params"], [0, 0, "300, 1, 255, 100"])
+
+
+class FlowRunnerTests(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.bulb = Bulb(ip="")
+        self.bulb._Bulb__socket = SocketMock()
+        original_send = self.bulb._Bulb__socket.send
+
+        def send(data):
+            original_send(data)
+            self.sent.append((time.monotonic(), self.bulb._Bulb__socket.sent))
+
+        self.bulb._Bulb__socket.send = send
+
+    def test_segments(self):
+        transitions = [RGBTransition(255, 0, 0, duration=100), SleepTransition(50)] * 4
+        flow = Flow(2, Flow.actions.off, transitions)
+        segments = list(flow._segments())
+        self.assertEqual([segment.params[:2] for segment, _ in segments], [[9, 1], [7, 2]])
+        self.assertEqual([duration for _, duration in segments], [0.7, 0.5])
+
+        # Recovering goes back to the state before the flow.
+        flow.action = Flow.actions.recover
+        properties = {"power": "on", "color_mode": "2", "ct": "2700", "bright": "40"}
+        segment, _ = list(flow._segments(properties=properties))[-1]
+        self.assertEqual(segment.params[:2], [8, 1])
+        self.assertTrue(segment.expression.endswith("50, 2, 2700, 40"))
+        self.assertEqual(list(flow._segments(properties={"power": "off"}))[-1][0].params[:2], [7, 0])
+
+        # Flows that run forever have segments forever.
+        flow.count = 0
+        self.assertEqual(len(list(islice(flow._segments(), 100))), 100)
+
+    def test_run_flow(self):
+        flow = Flow(1, Flow.actions.stay, [RGBTransition(0, 0, i, duration=50) for i in range(20)])
+        runner = self.bulb.run_flow(flow)
+        self.assertTrue(runner.wait(5))
+        self.assertIsNone(runner.exception)
+
+        flows = [(sent_at, command["params"]) for sent_at, command in self.sent if command["method"] == "start_cf"]
+        self.assertEqual([params[:2] for _, params in flows], [[9, 1], [9, 1], [2, 1]])
+        self.assertTrue(flows[2][1][2].startswith("50, 1, 18, 100"))
+        # Every segment starts when the one before it ends.
+        self.assertAlmostEqual(flows[1][0] - flows[0][0], 0.45, delta=0.05)
+        self.assertAlmostEqual(flows[2][0] - flows[0][0], 0.9, delta=0.05)
+
+    def test_auto_on(self):
+        # The bulb is only turned on once, not before every segment.
+        self.bulb.auto_on = True
+        runner = self.bulb.run_flow(Flow(1, Flow.actions.stay, [SleepTransition(50)] * 20))
+        self.assertTrue(runner.wait(5))
+        methods = [command["method"] for _, command in self.sent]
+        self.assertEqual(methods, ["get_prop", "set_power", "start_cf", "start_cf", "start_cf"])
+
+    def test_stop_flow(self):
+        runner = self.bulb.run_flow(Flow(0, Flow.actions.stay, [SleepTransition(50)] * 10))
+        self.assertTrue(runner.running)
+        self.bulb.stop_flow()
+        self.assertTrue(runner.wait(1))
+        self.assertEqual(self.sent[-1][1]["method"], "stop_cf")
+        time.sleep(0.6)
+        self.assertEqual(self.sent[-1][1]["method"], "stop_cf")
+
+
+class SimulatorTests(unittest.TestCase):
+    def setUp(self):
+        transitions = [
+            RGBTransition(255, 0, 0, duration=500, brightness=50),
+            SleepTransition(300),
+            TemperatureTransition(2700, duration=400, brightness=80),
+            HSVTransition(200, 60, duration=700, brightness=-1),
+        ]
+        self.flow = Flow(2, Flow.actions.recover, transitions)
+
+    def test_state(self):
+        flow = Flow(1, Flow.actions.off, [RGBTransition(255, 0, 0, duration=1000)])
+        simulation = FlowSimulator(flow, start=(0x0000FF, 20))
+        self.assertEqual(simulation.duration, 1000)
+        self.assertEqual(simulation.state(-1), (0x0000FF, 20))
+        self.assertEqual(simulation.state(500), (0x800080, 60))
+        self.assertEqual(simulation.state(1000), (0xFF0000, 0))
+
+        simulation = FlowSimulator(self.flow, start=(0x123456, 10))
+        self.assertEqual(simulation.state(600), (0xFF0000, 50))  # Sleeping.
+        self.assertEqual(simulation.state(1200), (color.kelvin_to_rgb(2700), 80))
+        self.assertEqual(simulation.state(1900), (HSVTransition(200, 60)._value, 80))
+        # The second run starts from where the first one ended.
+        self.assertEqual(simulation.state(1900 + 250)[1], 65)
+        self.assertEqual(simulation.state(3800), (0x123456, 10))
+
+        # Flows that run forever start from where they end, by default.
+        self.flow.count = 0
+        simulation = FlowSimulator(self.flow)
+        self.assertIsNone(simulation.duration)
+        self.assertEqual(simulation.state(0), simulation.state(1900 * 1000))
+
+    def check_sample(self, simulation):
+        times = [index * 10 for index in range(-100, 500)]
+        rgb, brightness = simulation.sample(times)
+        states = [simulation.state(time) for time in times]
+        self.assertEqual(list(rgb), [state[0] for state in states])
+        self.assertEqual(list(brightness), [state[1] for state in states])
+
+        times, rgb, brightness = simulation.timeline(fps=10)
+        self.assertEqual(len(times), 39)
+        self.assertEqual((rgb[-1], brightness[-1]), simulation.final)
+
+    def test_sample(self):
+        if simulator.numpy is None:
+            self.skipTest("NumPy is not installed.")
+        self.check_sample(FlowSimulator(self.flow, start=(0x123456, 10)))
+
+    def test_sample_pure_python(self):
+        numpy, simulator.numpy = simulator.numpy, None
+        try:
+            self.check_sample(FlowSimulator(self.flow, start=(0x123456, 10)))
+        finally:
+            simulator.numpy = numpy
+
+
+class ColorTests(unittest.TestCase):
+    def colorsys_rgb(self, hue, saturation, value):
+        red, green, blue = [
+            int(round(col * 255)) for col in colorsys.hsv_to_rgb(hue / 359.0, saturation / 100.0, value / 100.0)
+        ]
+        return red * 65536 + green * 256 + blue
+
+    def check(self):
+        hues = list(range(0, 360, 7)) + [12.5, 359]
+        saturations = [(hue * 3) % 101 for hue in hues]
+        values = [(hue * 7) % 101 for hue in hues]
+        expected = [self.colorsys_rgb(*hsv) for hsv in zip(hues, saturations, values)]
+        self.assertEqual(list(color.hsv_to_rgb(hues, saturations, values)), expected)
+        self.assertEqual([color.hsv_to_rgb(*hsv) for hsv in zip(hues, saturations, values)], expected)
+
+        # Single values apply to every color, and values are clamped.
+        self.assertEqual(list(color.hsv_to_rgb([-10, 120, 400], 100)), [16711680, 65281, 16711680])
+        self.assertEqual(list(color.rgb_to_int([255, 0, 300], [0, 255, -1], 1)), [16711681, 65281, 16711681])
+        self.assertEqual(color.rgb_to_int(1, 2, 3), 66051)
+        if color.numpy is not None:
+            frame = color.numpy.array([[255, 0], [128, 255], [1, 255]], dtype=color.numpy.uint8)
+            self.assertEqual(list(color.rgb_to_int(*frame)), [16744449, 65535])
+
+        kelvins = [1000, 1700, 2700, 4000, 6500, 6600, 10000, 40000]
+        self.assertEqual(list(color.kelvin_to_rgb(kelvins)), [color.kelvin_to_rgb(k) for k in kelvins])
+        self.assertEqual(color.kelvin_to_rgb(6600), 0xFFFFFF)
+        self.assertEqual(color.kelvin_to_rgb(1000) >> 16, 255)
+
+    def test_numpy(self):
+        if color.numpy is None:
+            self.skipTest("NumPy is not installed.")
+        self.check()
+
+    def test_pure_python(self):
+        numpy, color.numpy = color.numpy, None
+        try:
+            self.check()
+        finally:
+            color.numpy = numpy
+
+    def test_transitions(self):
+        self.assertEqual(HSVTransition(200, 100)._value, self.colorsys_rgb(200, 100, 100))
+        self.assertEqual(RGBTransition(300, 128, -5)._value, 16744448)
+
+
+class LineDecoderTests(unittest.TestCase):
+    def test_split_lines(self):
+        decoder = _LineDecoder()
+        self.assertEqual(decoder.feed(b'{"id": 1, "res'), [])
+        self.assertEqual(decoder.feed(b'ult": ["ok"]}\r'), [])
+        self.assertEqual(
+            decoder.feed(b'\n{"method": "props", "params": {}}\r\n{"id": 2'),
+            [{"id": 1, "result": ["ok"]}, {"method": "props", "params": {}}],
+        )
+        self.assertEqual(decoder.feed(b', "result": ["ok"]}\r\n'), [{"id": 2, "result": ["ok"]}])
+
+    def test_invalid_line(self):
+        decoder = _LineDecoder()
+        self.assertEqual(decoder.feed(b"nonsense\r\n\r\n"), [{"result": ["invalid command"]}])
+
+    def test_split_response(self):
+        bulb = Bulb(ip="")
+        bulb._Bulb__socket = SocketMock()
+        future = bulb.submit_command("set_bright", [10])
+        response = b'{"id": %d, "result": ["ok"]}\r\n' % bulb._Bulb__socket.sent["id"]
+        bulb._Bulb__socket.received = response[:10]
+        bulb._read_responses()
+        self.assertFalse(future.done())
+        bulb._Bulb__socket.received = response[10:]
+        self.assertEqual(future.result(), {"id": bulb._Bulb__socket.sent["id"], "result": ["ok"]})
+
+
+class ListenerTests(unittest.TestCase):
+    def setUp(self):
+        self.bulb_socket, self.socket = socket.socketpair()
+        self.bulb_socket.settimeout(0.1)
+        self.bulb = Bulb(ip="")
+        self.bulb._Bulb__socket = self.bulb_socket
+
+    def tearDown(self):
+        self.bulb.stop_listening()
+        self.bulb._close_socket()
+        self.socket.close()
+
+    def test_notifications(self):
+        notified = threading.Event()
+        self.bulb.start_listening(lambda params: notified.set())
+        self.socket.sendall(b'{"method": "props", "params": {"power": "off"}}\r\n')
+        self.assertTrue(notified.wait(5))
+        self.assertEqual(self.bulb.last_properties["power"], "off")
+
+    def test_callback_command(self):
+        # The callback can send commands, as it doesn't run on the reading thread.
+        results = []
+
+        def callback(params):
+            results.append(self.bulb.send_command("set_bright", [10])["result"])
+
+        def respond():
+            command = json.loads(self.socket.recv(1024).decode("utf8"))
+            self.socket.sendall(('{"id": %s, "result": ["ok"]}\r\n' % command["id"]).encode("utf8"))
+
+        self.bulb.start_listening(callback)
+        responder = threading.Thread(target=respond)
+        responder.start()
+        self.socket.sendall(b'{"method": "props", "params": {"power": "off"}}\r\n')
+        responder.join(5)
+        for _ in range(50):
+            if results:
+                break
+            time.sleep(0.1)
+        self.assertEqual(results, [["ok"]])
+
+    def test_command(self):
+        self.bulb.start_listening()
+        future = self.bulb.submit_command("set_bright", [10])
+        command = json.loads(self.socket.recv(1024).decode("utf8"))
+        self.socket.sendall(('{"id": %s, "result": ["ok"]}\r\n' % command["id"]).encode("utf8"))
+        self.assertEqual(future.result(5)["result"], ["ok"])
+
+    def test_batch(self):
+        def respond():
+            command = json.loads(self.socket.recv(1024).decode("utf8"))
+            self.socket.sendall(('{"id": %s, "result": ["ok"]}\r\n' % command["id"]).encode("utf8"))
+
+        self.bulb.start_listening()
+        responder = threading.Thread(target=respond)
+        responder.start()
+        with self.bulb.batch():
+            self.bulb.set_brightness(10)
+        responder.join(5)
+
+    def test_result_timeout(self):
+        # Giving up on a command the bulb doesn't answer leaves the connection,
+        # and the other commands, alone.
+        self.bulb_socket.settimeout(5)
+        first = self.bulb.submit_command("set_bright", [10])
+        second = self.bulb.submit_command("set_ct_abx", [2700])
+        start = time.monotonic()
+        with self.assertRaises(FutureTimeoutError):
+            first.result(0.1)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertIs(self.bulb._Bulb__socket, self.bulb_socket)
+        self.assertEqual(self.bulb_socket.gettimeout(), 5)
+        self.assertFalse(second.done())
+
+        commands = [json.loads(line) for line in self.socket.recv(1024).decode("utf8").splitlines()]
+        for command in commands:
+            self.socket.sendall(('{"id": %s, "result": ["ok"]}\r\n' % command["id"]).encode("utf8"))
+        self.assertEqual(first.result(5)["result"], ["ok"])
+        self.assertEqual(second.result(5)["result"], ["ok"])
+
+
+def advertisement(bulb_id="0x0000000002dfb19a", ip="192.168.0.19", power="on", max_age=3600):
+    lines = [
+        "NOTIFY * HTTP/1.1",
+        "Host: 239.255.255.250:1982",
+        "Cache-Control: max-age=%s" % max_age,
+        "Location: yeelight://%s:55443" % ip,
+        "NTS: ssdp:alive",
+        "Server: POSIX, UPnP/1.0 YGLC/1",
+        "id: %s" % bulb_id,
+        "model: color",
+        "support: get_prop set_default set_power toggle set_bright",
+        "power: %s" % power,
+        "name: ",
+    ]
+    return "\r\n".join(lines).encode("utf8")
+
+
+class BulbListenerTests(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.listener = BulbListener(
+            on_appear=lambda bulb: self.events.append(("appear", bulb["ip"], bulb["capabilities"]["power"])),
+            on_change=lambda bulb: self.events.append(("change", bulb["ip"], bulb["capabilities"]["power"])),
+            on_expire=lambda bulb: self.events.append(("expire", bulb["ip"], bulb["capabilities"]["power"])),
+        )
+
+    def test_inventory(self):
+        self.listener._handle_message(advertisement(), 0)
+        self.listener._handle_message(advertisement(), 10)
+        self.listener._handle_message(advertisement(power="off"), 20)
+        self.listener._handle_message(advertisement("0x1", "192.168.0.20", max_age=60), 30)
+        self.assertEqual(
+            self.events,
+            [("appear", "192.168.0.19", "on"), ("change", "192.168.0.19", "off"), ("appear", "192.168.0.20", "on")],
+        )
+
+        bulbs = self.listener.bulbs
+        self.assertEqual(sorted(bulbs), ["0x0000000002dfb19a", "0x1"])
+        self.assertEqual(bulbs["0x1"]["port"], 55443)
+        self.assertEqual(bulbs["0x1"]["capabilities"]["name"], "")
+
+    def test_expiry(self):
+        self.listener._handle_message(advertisement(), 0)
+        self.listener._handle_message(advertisement("0x1", "192.168.0.20", max_age=60), 0)
+        self.listener._expire(100)
+        self.assertEqual(self.events[-1], ("expire", "192.168.0.20", "on"))
+        self.assertEqual(list(self.listener.bulbs), ["0x0000000002dfb19a"])
+
+    def test_ignore_search(self):
+        search = b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1982\r\nMAN: "ssdp:discover"\r\nST: wifi_bulb'
+        self.listener._handle_message(search, 0)
+        self.assertEqual(self.listener.bulbs, {})
+
+
+def loopback_interface():
+    """Return the name of the loopback interface, or skip the test if it can't be found."""
+    with contextlib.suppress(AttributeError, OSError):
+        for _, name in socket.if_nameindex():
+            with contextlib.suppress(OSError):
+                if get_ip_address(name) == "127.0.0.1":
+                    return name
+    raise unittest.SkipTest("The loopback interface can't be found.")
+
+
+def require_addresses(*addresses):
+    """Skip the test unless we can bind to all the given addresses, which might be missing loopback aliases."""
+    for address in addresses:
+        try:
+            with socket.socket() as sock:
+                sock.bind((address, 0))
+        except OSError:
+            raise unittest.SkipTest("Can't bind to %s." % address)
+
+
+class DiscoveryTests(unittest.TestCase):
+    def setUp(self):
+        self.interface = loopback_interface()
+
+        # Answer the searches sent over the loopback interface.
+        self.responder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.responder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.responder.bind(("", 1982))
+            membership = struct.pack("4s4s", socket.inet_aton("239.255.255.250"), socket.inet_aton("127.0.0.1"))
+            self.responder.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError as ex:
+            self.responder.close()
+            raise unittest.SkipTest("Can't listen for searches: %s" % ex)
+        self.searches = 0
+        self.searchers = set()
+        threading.Thread(target=self.respond, daemon=True).start()
+
+    def tearDown(self):
+        self.responder.close()
+
+    def respond(self):
+        try:
+            while True:
+                data, addr = self.responder.recvfrom(65507)
+                self.searches += 1
+                self.searchers.add(addr)
+                for i in range(3):
+                    self.responder.sendto(advertisement("0x%s" % i, "192.168.0.%s" % i), addr)
+        except OSError:
+            pass
+
+    def test_discover_bulbs(self):
+        bulbs = discover_bulbs(timeout=0.5, interface=self.interface)
+        self.assertEqual(sorted(bulb["ip"] for bulb in bulbs), ["192.168.0.0", "192.168.0.1", "192.168.0.2"])
+        # The search was sent again, but the bulbs were only returned once.
+        self.assertGreater(self.searches, 1)
+
+    def test_expected(self):
+        start = time.monotonic()
+        bulbs = list(discover_bulbs_iter(timeout=5, interface=self.interface, expected={"0x0", "0x1"}))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([bulb["capabilities"]["id"] for bulb in bulbs], ["0x0", "0x1"])
+
+    def test_quiet(self):
+        start = time.monotonic()
+        bulbs = list(discover_bulbs_iter(timeout=5, interface=self.interface))
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(len(bulbs), 3)
+
+    def test_interfaces(self):
+        bulbs = discover_bulbs(timeout=0.3, interface=[self.interface, self.interface])
+        self.assertEqual(sorted(bulb["capabilities"]["id"] for bulb in bulbs), ["0x0", "0x1", "0x2"])
+        # Both interfaces were searched, but each bulb was only returned once.
+        self.assertEqual(len(self.searchers), 2)
+
+    def test_cache(self):
+        path = os.path.join(tempfile.mkdtemp(), "bulbs.json")
+        cache = DiscoveryCache(path)
+        self.assertEqual(len(cache.discover(timeout=0.5, interface=self.interface)), 3)
+
+        # A new process starts straight from the cache, without searching.
+        searches = self.searches
+        cache = DiscoveryCache(path)
+        bulbs = cache.discover(timeout=0.5, interface=self.interface, revalidate=False)
+        self.assertEqual(sorted(bulb["capabilities"]["id"] for bulb in bulbs), ["0x0", "0x1", "0x2"])
+        self.assertEqual(self.searches, searches)
+
+        # Expired bulbs are ignored.
+        self.assertEqual(DiscoveryCache(path, ttl=0).bulbs, [])
+
+    def test_cache_revalidate(self):
+        cache = DiscoveryCache(os.path.join(tempfile.mkdtemp(), "bulbs.json"))
+        # The responder is at 127.0.0.1, but claims the bulbs are elsewhere.
+        cache.update([{"ip": "127.0.0.1", "port": 55443, "capabilities": {"id": "0x0"}}])
+        self.assertEqual([bulb["capabilities"]["id"] for bulb in cache.revalidate(timeout=0.5)], ["0x0"])
+        self.assertEqual([bulb["ip"] for bulb in cache.bulbs], ["192.168.0.0"])
+
+
+class ScanTests(unittest.TestCase):
+    def setUp(self):
+        require_addresses("127.0.0.5")
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.5", 0))
+        self.server.listen(128)
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def tearDown(self):
+        self.server.close()
+
+    def serve(self):
+        with contextlib.suppress(OSError):
+            conn, _ = self.server.accept()
+            with conn:
+                command = json.loads(conn.makefile("rb").readline().decode("utf8"))
+                result = ["on", "10"] + [""] * (len(command["params"]) - 2)
+                conn.sendall((json.dumps({"id": command["id"], "result": result}) + "\r\n").encode("utf8"))
+
+    def test_scan(self):
+        bulbs = scan_bulbs("127.0.0.0/28", port=self.port, concurrency=4)
+        self.assertEqual([(bulb["ip"], bulb["port"]) for bulb in bulbs], [("127.0.0.5", self.port)])
+        self.assertEqual(bulbs[0]["capabilities"]["power"], "on")
+        self.assertEqual(bulbs[0]["capabilities"]["bright"], "10")
+
+
+class ReactorTests(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(128)
+        self.port = self.server.getsockname()[1]
+        self.methods = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+        self.reactor = BulbReactor(timeout=1)
+        self.reactor.start()
+
+    def tearDown(self):
+        self.reactor.stop()
+        self.server.close()
+
+    def serve(self):
+        try:
+            while True:
+                conn, _ = self.server.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        except OSError:
+            pass
+
+    def handle(self, conn):
+        with conn:
+            for line in conn.makefile("rb"):
+                command = json.loads(line.decode("utf8"))
+                self.methods.append(command["method"])
+                if command["method"] == "get_prop":
+                    result = ["on"] + [""] * (len(command["params"]) - 1)
+                elif command["method"] == "set_name":
+                    continue  # Never respond.
+                else:
+                    result = [command["method"]]
+                conn.sendall((json.dumps({"id": command["id"], "result": result}) + "\r\n").encode("utf8"))
+
+    def test_stop_right_away(self):
+        for _ in range(20):
+            reactor = BulbReactor()
+            reactor.start()
+            thread = reactor._thread
+            reactor.stop()
+            self.assertFalse(thread.is_alive())
+
+    def test_submit_after_stop(self):
+        self.reactor.stop()
+        future = self.reactor.submit(Bulb("127.0.0.1", self.port), "set_brightness", 10)
+        self.assertRaises(BulbException, future.result, 1)
+        self.assertRaises(BulbException, self.reactor.start)
+
+    def test_stop_closes(self):
+        self.reactor.stop()
+        self.assertEqual(self.reactor._waker.fileno(), -1)
+        self.assertEqual(self.reactor._wakee.fileno(), -1)
+        self.assertIsNone(self.reactor._selector.get_map())
+
+    def test_auto_on(self):
+        bulb = Bulb("127.0.0.1", self.port, auto_on=True, power_ttl=60)
+        self.reactor.submit(bulb, "turn_off").result(5)
+        self.reactor.submit(bulb, "set_rgb", 255, 0, 0).result(5)
+        # The bulb was just turned on, so it isn't turned on again.
+        self.reactor.submit(bulb, "set_brightness", 10).result(5)
+        self.assertEqual(self.methods, ["set_power", "set_power", "set_rgb", "set_bright"])
+
+    def test_many_bulbs(self):
+        bulbs = [Bulb("127.0.0.1", self.port) for _ in range(20)]
+        futures = [self.reactor.submit(bulb, "set_rgb", 255, 0, 0) for bulb in bulbs]
+        futures += [self.reactor.submit(bulb, "set_brightness", 10) for bulb in bulbs]
+        self.assertEqual([future.result(5) for future in futures], ["set_rgb"] * 20 + ["set_bright"] * 20)
+
+    def test_get_properties(self):
+        bulb = Bulb("127.0.0.1", self.port)
+        self.assertEqual(self.reactor.get_properties(bulb).result(5)["power"], "on")
+        self.assertEqual(bulb.last_properties["power"], "on")
+
+    def test_timeout(self):
+        future = self.reactor.submit(Bulb("127.0.0.1", self.port), "set_name", "bedroom")
+        self.assertRaises(BulbException, future.result, 5)
+
+
+class GroupTests(unittest.TestCase):
+    serve = ReactorTests.serve
+    handle = ReactorTests.handle
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(128)
+        self.port = self.server.getsockname()[1]
+        self.methods = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+        # A bulb that accepts connections, but never responds.
+        self.silent = socket.socket()
+        self.silent.bind(("127.0.0.1", 0))
+        self.silent.listen(128)
+
+    def tearDown(self):
+        self.server.close()
+        self.silent.close()
+
+    def test_fan_out(self):
+        bulbs = [Bulb("127.0.0.1", self.port) for _ in range(10)]
+        slow = Bulb("127.0.0.1", self.silent.getsockname()[1])
+        group = BulbGroup(bulbs + [slow], timeout=0.5)
+
+        start = time.monotonic()
+        results = group.set_rgb(255, 0, 0)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(list(results), bulbs + [slow])
+        self.assertEqual([results[bulb].result for bulb in bulbs], ["set_rgb"] * 10)
+        self.assertTrue(all(results[bulb].error is None and results[bulb].latency < 0.5 for bulb in bulbs))
+        self.assertIsInstance(results[slow].error, BulbException)
+        self.assertIsNone(results[slow].latency)
+        group.close()
+
+    def test_cancel_late(self):
+        received = []
+
+        def respond_slowly():
+            conn, _ = self.silent.accept()
+            with conn:
+                for line in conn.makefile("rb"):
+                    command = json.loads(line.decode("utf8"))
+                    received.append(command["method"])
+                    time.sleep(1.2)
+                    conn.sendall((json.dumps({"id": command["id"], "result": ["ok"]}) + "\r\n").encode("utf8"))
+
+        threading.Thread(target=respond_slowly, daemon=True).start()
+        fast = Bulb("127.0.0.1", self.port)
+        slow = Bulb("127.0.0.1", self.silent.getsockname()[1])
+        group = BulbGroup([fast, slow], timeout=0.5)
+
+        group.set_rgb(255, 0, 0)
+        # The slow bulb is still busy, so the next command to it is cancelled
+        # rather than sent late, and the other bulb isn't held up.
+        results = group.toggle()
+        self.assertEqual(results[fast].result, "toggle")
+        self.assertIsInstance(results[slow].error, BulbException)
+        time.sleep(0.5)
+        self.assertEqual(received, ["set_rgb"])
+        group.close()
+
+
+class MusicTests(unittest.TestCase):
+    def setUp(self):
+        self.connect_back = True
+        self.received = []
+        self.hub = MusicHub()
+        self.server = socket.socket()
+        self.server.bind(("", 0))
+        self.server.listen(128)
+        self.port = self.server.getsockname()[1]
+        self.music_connections = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def tearDown(self):
+        self.hub.close()
+        self.server.close()
+        for conn in self.music_connections:
+            conn.close()
+
+    def serve(self):
+        try:
+            while True:
+                conn, _ = self.server.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        except OSError:
+            pass
+
+    def handle(self, conn):
+        with conn, contextlib.suppress(OSError):
+            for line in conn.makefile("rb"):
+                command = json.loads(line.decode("utf8"))
+                self.received.append(command)
+                if command["method"] == "get_prop":
+                    result = ["on"] + [""] * (len(command["params"]) - 1)
+                else:
+                    result = ["ok"]
+                if command["params"][:1] == [1] and command["method"] == "set_music" and self.connect_back:
+                    _, host, port = command["params"]
+                    # Connect from the address the bulb is on.
+                    source = (conn.getsockname()[0], 0)
+                    self.music_connections.append(socket.create_connection((host, port), source_address=source))
+                conn.sendall((json.dumps({"id": command["id"], "result": result}) + "\r\n").encode("utf8"))
+
+    def test_start_music(self):
+        addresses = ["127.0.0.%s" % i for i in range(1, 11)]
+        require_addresses(*addresses)
+        bulbs = [Bulb(address, self.port) for address in addresses]
+        self.assertEqual(self.hub.start_music(bulbs), {bulb: None for bulb in bulbs})
+        self.assertTrue(all(bulb.music_mode for bulb in bulbs))
+        self.assertEqual(len({bulb._socket.getpeername() for bulb in bulbs}), 10)
+
+    def test_stale_connection(self):
+        # A bulb that connects after a previous deadline isn't handed to the
+        # next call.
+        stale = socket.create_connection(("127.0.0.1", self.hub.port))
+        self.connect_back = False
+        bulb = Bulb("127.0.0.1", self.port)
+        self.assertIsInstance(self.hub.start_music([bulb], timeout=0.2)[bulb], BulbException)
+        self.assertFalse(bulb.music_mode)
+        self.assertEqual(stale.recv(1), b"")
+        stale.close()
+
+    def test_bulb_start_music(self):
+        bulb = Bulb("127.0.0.1", self.port)
+        self.assertEqual(bulb.start_music(), "ok")
+        self.assertTrue(bulb.music_mode)
+        self.assertEqual(len(self.music_connections), 1)
+
+    def test_start_music_timeout(self):
+        self.connect_back = False
+        bulb = Bulb("127.0.0.1", self.port)
+        self.assertRaises(BulbException, bulb.start_music, timeout=0.2)
+        self.assertFalse(bulb.music_mode)
+        self.assertEqual(self.received[-1]["method"], "set_music")
+        self.assertEqual(self.received[-1]["params"], [0])
+        # The old connection still works.
+        self.assertEqual(bulb.get_properties()["power"], "on")
+
+    def test_begin_music_cancel(self):
+        self.connect_back = False
+        bulb = Bulb("127.0.0.1", self.port)
+        future = bulb.begin_music()
+        while not any(command["method"] == "set_music" for command in self.received):
+            time.sleep(0.01)
+        self.assertTrue(future.cancel())
+        while self.received[-1]["params"] != [0]:
+            time.sleep(0.01)
+        self.assertFalse(bulb.music_mode)
+
+    def test_async_start_music(self):
+        require_addresses("127.0.0.2")
+        loop = asyncio.new_event_loop()
+        bulb = AsyncBulb("127.0.0.1", self.port)
+        self.assertEqual(loop.run_until_complete(bulb.async_start_music()), "ok")
+        self.assertTrue(bulb.music_mode)
+        self.assertEqual(loop.run_until_complete(bulb.async_set_rgb(255, 0, 0)), "ok")
+
+        self.connect_back = False
+        bulb = AsyncBulb("127.0.0.2", self.port)
+        with self.assertRaises(BulbException):
+            loop.run_until_complete(bulb.async_start_music(timeout=0.2))
+        self.assertFalse(bulb.music_mode)
+        self.assertEqual(self.received[-1]["params"], [0])
+        loop.run_until_complete(bulb.async_close())
+        loop.close()
+
+
+class AsyncTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.received = []
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, "127.0.0.1", 0))
+        port = self.server.sockets[0].getsockname()[1]
+        self.bulb = AsyncBulb(ip="127.0.0.1", port=port)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.bulb.async_close())
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    async def handle(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = json.loads(line.decode("utf8"))
+            self.received.append(command)
+            if command["method"] == "get_prop":
+                result = ["off"] + [""] * (len(command["params"]) - 1)
+            else:
+                result = ["ok"]
+            # A notification and a stale reply should both be skipped.
+            writer.write(b'{"method": "props", "params": {"bright": "42"}}\r\n')
+            writer.write(b'{"id": -1, "result": ["stale"]}\r\n')
+            writer.write((json.dumps({"id": command["id"], "result": result}) + "\r\n").encode("utf8"))
+        writer.close()
+
+    def test_set_rgb(self):
+        result = self.loop.run_until_complete(self.bulb.async_set_rgb(255, 255, 0, effect="sudden"))
+        self.assertEqual(result, "ok")
+        self.assertEqual(self.received[-1]["method"], "set_rgb")
+        self.assertEqual(self.received[-1]["params"], [16776960, "sudden", 300])
+        self.assertEqual(self.bulb.last_properties["bright"], "42")
+
+    def test_auto_on(self):
+        self.bulb.auto_on = True
+        self.loop.run_until_complete(self.bulb.async_set_brightness(50))
+        self.assertEqual([command["method"] for command in self.received], ["get_prop", "set_power", "set_bright"])
+        self.assertEqual(self.received[-1]["params"], [50, "smooth", 300])
+
+    def test_get_properties(self):
+        properties = self.loop.run_until_complete(self.bulb.async_get_properties())
+        self.assertEqual(properties["power"], "off")
+        self.assertEqual(properties["current_brightness"], "0")
+
+    def test_run_flow(self):
+        async def run():
+            task = await self.bulb.async_run_flow(Flow(1, Flow.actions.stay, [SleepTransition(50)] * 12))
+            await task
+            task = await self.bulb.async_run_flow(Flow(0, Flow.actions.stay, [SleepTransition(50)] * 12))
+            await self.bulb.async_stop_flow()
+            await asyncio.sleep(0.6)
+            return task
+
+        task = self.loop.run_until_complete(run())
+        self.assertTrue(task.cancelled())
+        self.assertEqual([command["params"][0] for command in self.received[:2]], [9, 3])
+        self.assertEqual(self.received[-1]["method"], "stop_cf")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,3 +1,8 @@
+import json
+import threading
+import time
+
+
 def _clamp(value, minx, maxx):
     """
     Constrain a value between a minimum and a maximum.
@@ -10,3 +15,101 @@ def _clamp(value, minx, maxx):
     :param int maxx: The maximum the value can take.
     """
     return max(minx, min(maxx, value))
+
+
+class _LineDecoder(object):
+    """
+    An incremental decoder for the JSON lines the bulbs send.
+
+    Data is fed to the decoder as it arrives, and any partial line at the end
+    of it is kept until the rest of it arrives, so lines split across TCP
+    segments are decoded correctly.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0  # How much of the buffer we know contains no newlines.
+
+    def feed(self, data):
+        """
+        Add received data to the buffer and decode all the complete lines in it.
+
+        Lines that aren't valid JSON are decoded to ``{"result": ["invalid
+        command"]}``, which is what the bulb would have said about them.
+
+        :param bytes data: The data that was received.
+
+        :returns: A list of the decoded messages.
+        :rtype: list
+        """
+        buffer = self._buffer
+        buffer += data
+
+        messages = []
+        start = 0
+        end = buffer.find(b"\n", self._scanned)
+        while end != -1:
+            # Lines end in "\r\n", but be lenient and accept a bare "\n".
+            line_end = end - 1 if end > start and buffer[end - 1] == 13 else end
+            if line_end > start:
+                try:
+                    messages.append(json.loads(buffer[start:line_end].decode("utf8")))
+                except ValueError:
+                    messages.append({"result": ["invalid command"]})
+            start = end + 1
+            end = buffer.find(b"\n", start)
+
+        # Only drop the decoded lines once, rather than after every line.
+        del buffer[:start]
+        self._scanned = len(buffer)
+        return messages
+
+
+class _TokenBucket(object):
+    """
+    A token bucket, used to limit the rate of commands sent to a bulb.
+
+    The bucket holds up to ``quota`` tokens and is refilled at ``quota`` tokens
+    per ``period`` seconds. Every command takes a token.
+    """
+
+    def __init__(self, quota, period=60):
+        self.quota = quota
+        self.period = period
+
+        self._tokens = float(quota)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """Add the tokens that have accumulated since the last refill."""
+        now = time.monotonic()
+        self._tokens = min(self.quota, self._tokens + (now - self._updated) * self.quota / self.period)
+        self._updated = now
+
+    @property
+    def remaining(self):
+        """The number of tokens that can be taken right now."""
+        with self._lock:
+            self._refill()
+            return max(0, int(self._tokens))
+
+    def reserve(self, wait=True):
+        """
+        Take a token, possibly one that isn't available yet.
+
+        :param bool wait: Whether to reserve a token that will only become
+                          available in the future. If this is False and there
+                          are no tokens available, no token is taken.
+
+        :returns: How many seconds the caller has to wait before the token is
+                  available, or None if ``wait`` is False and there were no
+                  tokens available.
+        """
+        with self._lock:
+            self._refill()
+            if not wait and self._tokens < 1:
+                return None
+
+            self._tokens -= 1
+            return max(0, -self._tokens * self.period / self.quota)